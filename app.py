@@ -1,17 +1,28 @@
+import os
 import dash
 from dash import dcc
 from dash import html
 from dash.exceptions import PreventUpdate
 import json 
-import pandas as pd
 from plotly import graph_objs as go
 from plotly.subplots import make_subplots
 
-from datetime import datetime as dt 
-from dash.dependencies import Output, Input, State, ALL 
+from dash.dependencies import Output, Input, State, ALL, ClientsideFunction
 
+import flask
+import numpy as np
 import queries as q
-from time_slicing import get_delta
+import metrics
+import live
+import screener
+import compare
+import kernels
+import prefetch
+from series_store import store, Series
+from result_cache import results
+from time_slicing import get_level, time_map
+from downsample import downsample, MAX_POINTS
+from codec import encode, encode_dates
 from time_slicing import ALL_Y, FIVE_Y, ONE_Y, THREE_M, ONE_M, ONE_W
 
 ######## WEB LAYOUT ########
@@ -35,6 +46,7 @@ def base_layout():
         plot_bgcolor='rgba(0,0,0,0)',
         font_color='white',
         xaxis={
+            'type': 'date',
             'gridcolor': '#444',
             'showgrid': True,
             'zeroline': False
@@ -61,13 +73,93 @@ app = dash.Dash(
 	__name__
 )
 server = app.server 
+metrics.install(app)
+metrics.gauges['result_cache'] = results.stats
+metrics.gauges['prefetch'] = lambda: {'warm': len(prefetch.scheduler.warm)}
+
+@server.before_request
+def start_prefetch():
+    # Keeps the most viewed tickers computed ahead of time (see
+    # prefetch.py), but only in processes that serve requests, not in
+    # every script or reloader that imports the app
+    prefetch.start()
+
+@server.route('/cache-stats')
+def cache_stats():
+    return results.stats()
+
+# Most tickers /compare and /screen take in one request. Each one can
+# mean a full download and a table in the cache every worker shares
+MAX_ROUTE_TICKERS = int(os.environ.get('MAX_ROUTE_TICKERS', 20))
+
+def route_tickers(arg, *extra):
+    '''
+    Comma separated tickers plus extra, without repeats. Anything past
+    MAX_ROUTE_TICKERS is a 400
+    '''
+    tickers = list(dict.fromkeys(
+        t for t in arg.upper().split(',') + [e.upper() for e in extra] if t
+    ))
+    if len(tickers) > MAX_ROUTE_TICKERS:
+        flask.abort(400, 'at most %d tickers at a time' % MAX_ROUTE_TICKERS)
+
+    return tickers
+
+@server.route('/compare')
+def compare_route():
+    '''
+    compare.compare as JSON, e.g. /compare?tickers=QQQ,AAPL&benchmark=SPY
+    '''
+    args = flask.request.args
+    window = args.get('window', compare.CORR_WINDOW, type=int)
+    if window < 2:
+        flask.abort(400, 'window has to be at least 2 bars')
+
+    benchmark = args.get('benchmark', 'SPY').upper()
+    tickers = route_tickers(args.get('tickers', ''), benchmark)
+
+    ret = compare.compare(tickers, benchmark, window=window)
+    if ret is None:
+        flask.abort(404)
+
+    return flask.jsonify(ret)
+
+@server.route('/screen')
+def screen():
+    '''
+    screener.screen as JSON, e.g. /screen?tickers=SPY,QQQ&smooth=4.
+    Without tickers the whole universe is screened
+    '''
+    args = flask.request.args
+    tickers = args.get('tickers')
+
+    return flask.jsonify(screener.screen(
+        route_tickers(tickers) if tickers else None,
+        smooth=args.get('smooth', 4, type=float),
+        within=args.get('within', 5, type=int),
+        top=args.get('top', 50, type=int)
+    ))
 
 app.title = 'Stock Price Analyzer'
 app.layout = html.Div(
     [     
         dcc.Store(id='memory'),
+        # Only holds the session id; the series themselves stay on the server
         dcc.Store(id='graph-cache'),
         dcc.Store(id='last-forecast'),
+        # Series for every time window, so the slider never hits the server.
+        # The server only sends what changed (trace-delta), the browser merges
+        # it in and notes which versions it now has (trace-versions)
+        dcc.Store(id='trace-cache'),
+        dcc.Store(id='trace-delta'),
+        dcc.Store(id='trace-versions'),
+
+        # Live mode: every tick the server sends the bars each trace is
+        # missing (live-delta) and the browser appends them. live-cursor
+        # is the last bar it has of each
+        dcc.Store(id='live-delta'),
+        dcc.Store(id='live-cursor'),
+        dcc.Interval(id='live-interval', interval=live.LIVE_INTERVAL, disabled=True),
         
         # Search bar
         html.Div([
@@ -179,7 +271,23 @@ app.layout = html.Div(
                         },
                         debounce=False
                     ),
-                    html.P('weeks', style={'display': 'inline-block','margin-right': '10px'})
+                    html.P('weeks', style={'display': 'inline-block','margin-right': '10px'}),
+                    dcc.Dropdown(
+                        id='kernel',
+                        options=[
+                            {'label': label, 'value': name}
+                            for name, (label, _, _) in kernels.KERNELS.items()
+                        ],
+                        value='none',
+                        clearable=False,
+                        style={
+                            'display': 'inline-block',
+                            'width': '140px',
+                            'color': 'black',
+                            'vertical-align': 'middle',
+                            'margin-right': '10px'
+                        }
+                    )
                 ],
                 style={'display': 'inline-block'}
                 ),
@@ -197,6 +305,30 @@ app.layout = html.Div(
                 ],
                 style={'display': 'inline-block'}
                 ), 
+                html.Div([
+                    html.P("Compare to: ", style={'display': 'inline-block'}),
+                    dcc.RadioItems(
+                        id='benchmark',
+                        options=[
+                            {'label': '', 'value': ''}
+                        ],
+                        style={'display': 'inline-block'},
+                        labelStyle={'display': 'inline-block'},
+                        value=''
+                    )
+                ],
+                style={'display': 'inline-block', 'margin-left': '10px'}
+                ),
+                html.Div([
+                    dcc.Checklist(
+                        id='live',
+                        options=[{'label': 'Live', 'value': 'live'}],
+                        value=[],
+                        labelStyle={'display': 'inline-block'}
+                    )
+                ],
+                style={'display': 'inline-block', 'margin-left': '10px'}
+                ),
                 html.Div([
                     dcc.Slider(
                         min=0, max=100, step=None,
@@ -226,202 +358,378 @@ app.layout = html.Div(
 )
 
 ######## CALLBACKS ########
+# Most arrows drawn for the forecast ticker
+MAX_ARROWS = 25
+
 @app.callback(
     [
-        Output('live-graph', 'figure'),
+        Output('trace-delta', 'data'),
         Output('graph-cache', 'data'),
         Output('last-forecast', 'data')
     ],
     [
         Input({'type': 'derivatives', 'index': ALL}, 'value'),
         Input('rolling-avg', 'value'),
+        Input('kernel', 'value'),
         Input('forecast', 'value'),
-        Input('date_range', 'value')
+        Input('benchmark', 'value')
     ],
     [
-        State('live-graph', 'figure'),
         State('memory', 'data'),
         State('graph-cache', 'data'),
-        State('last-forecast', 'data')
+        State('last-forecast', 'data'),
+        State('trace-versions', 'data')
     ],
     prevent_initial_call=True
 )
-def update_graph(_, smooth, forecast, date_range, figure, mem, cached, last_forecast):
+@metrics.timed(metrics.callback_seconds, callback='update_graph')
+def update_graph(_, smooth, kernel, forecast, benchmark, mem, sid, last_forecast, versions):
+    '''
+    Sends the browser whatever it's missing to draw any time window; moving
+    the date_range slider is handled by graph.render in assets/clientside.js
+    '''
     ctx = dash.callback_context.triggered
 
     if smooth is None:
-        return figure, cached, last_forecast
+        raise PreventUpdate
+
+    # Only send the handle back to the browser when it changes
+    new_sid = dash.no_update
+    if sid is None:
+        sid = new_sid = store.new_session()
 
     smooth = int(smooth)
-    date_range = int(date_range)
-    cached = dict() if cached is None else cached
+    kernel = kernel or 'none'
+    cached = store.get(sid)
+    mem = mem or {'data': []}
     last_forecast = '' if last_forecast is None else last_forecast
 
-    if 'date_range' in ctx[0]['prop_id']:
-        if len(cached) == 0:
-            raise PreventUpdate
-        else:
-            fig_data = []
-
-            # Update lines plotted
-            for ticker, series in cached.items():
-                derivs = series[3]
-                
-                for d in derivs:
-                    fig_data.append(
-                        get_series(series[d], ticker, d, date_range)
-                    )
-
-            # Update arrows (if any)
-            if last_forecast:
-                figure['layout']['annotations'] = get_arrows(cached[forecast][2], date_range)        
-
-            return \
-                {'data': fig_data, 'layout': figure['layout']}, \
-                dash.no_update, dash.no_update
-
     if ctx[0]['prop_id'] == '.':
-        figure['data'] = []
-        figure['layout']['annotations'] = []
-        return {'data': figure['data'], 'layout': figure['layout']}, dict(), ''
+        store.clear(sid)
+        return trace_delta(dict(), '', smooth, kernel, versions), new_sid, ''
+
+    # Which derivatives are checked for every ticker. Read off the checklists
+    # each time so nothing is lost if this session was evicted
+    shown = {
+        str(child['id']['index']): [int(v) for v in child['value'] or []]
+        for child in dash.callback_context.inputs_list[0]
+        if str(child['id']['index']) in mem['data']
+    }
+
+    # Query yfinance if this is the first time seeing these tickers, or
+    # recompute their tables if the kernel changed
+    load_many(cached, shown.keys(), smooth, kernel)
+    prefetch.tracker.hit(shown.keys(), smooth, kernel)
+    for ticker, derivs in shown.items():
+        cached[ticker].shown = derivs
 
     # Update forecast
     if ctx[0]['prop_id'] == 'forecast.value':
-        if forecast == '':
-            figure['layout']['annotations'] = []
-            return {
-                'data': figure['data'],
-                'layout': figure['layout']
-            }, cached, ''
-
-        if forecast not in cached:
-            cached[forecast] = q.get_all(forecast, smooth=smooth) + [[]]
-
-        figure['layout']['annotations'] = get_arrows(cached[forecast][2], date_range)
-        return {
-            'data': figure['data'],
-            'layout': figure['layout']
-        }, cached, forecast
-
-    # Update smoothing on derivatives
-    if ctx[0]['prop_id'] == 'rolling-avg.value':
-        fig_dat = []
-
-        to_update = {}
-        for series in figure['data']:
-            ticker, deriv = series['name'].split(':')
-            
-            if ticker not in to_update:
-                to_update[ticker] = []
-            
-            to_update[ticker].append(deriv)
-    
-        for ticker, derivs in to_update.items():
-            # Only update valid stocks
-            if cached[ticker][0]:
-                cached[ticker][1] = q.first(*cached[ticker][0], smooth)
-                cached[ticker][2] = q.second(*cached[ticker][1], smooth)
-
-                fig_dat += [
-                    get_series(cached[ticker][int(i)], ticker, i, date_range) 
-                    for i in derivs
-                ]
-                
-                if last_forecast == ticker:
-                    figure['layout']['annotations'] = get_arrows(cached[ticker][2], date_range)
-
-        return {
-            'data': fig_dat,
-            'layout': figure['layout']
-        }, cached, last_forecast
-            
-
-    pids = [str(json.loads(child['prop_id'].split('.')[0])['index']) for child in ctx]
-
-    # Len is only greater than 1 if adding new stock
-    if len(pids) > 1:
-        for pid in pids:
-            if pid not in cached:
-                to_cache = q.get_all(pid, smooth=smooth)
-                if to_cache is None:
-                    cached[pid] = [[[],[]] * 3, []]
-                else:
-                    cached[pid] = to_cache + [[]]
-
-        return figure, cached, last_forecast
-
-    # Adding a new or cached chart
-    values = [str(v) for v in ctx[0]['value']]
-    ticker = pids[0]
-    
-    # Avoid duplicates and remove deleted series
-    new_dat = []
-    for d in figure['data']:
-        if d['customdatasrc'] != ticker and d['customdatasrc'] in mem['data']:
-            new_dat.append(d)
-
-    figure['data'] = new_dat
-
-    # Query yfinance if this is the first time seeing ticker
-    if ticker not in cached:
-        to_cache = q.get_all(ticker, smooth=smooth)
-        if to_cache is None:
-            cached[ticker] = [[[],[]] * 3, []]
-        else:
-            cached[ticker] = to_cache + [[]]
-
-    for v in values:
-        series = get_series(cached[ticker][int(v)], ticker, v, date_range)
-        figure['data'].append(series)
-
-    # Keeps track of which derivatives are displayed
-    cached[ticker][3] = [int(v) for v in values]
-    
+        last_forecast = forecast or ''
+        if last_forecast:
+            load_series(cached, last_forecast, smooth, kernel)
+
     # Sync pid cache and graph cache
-    cached_keys = list(cached.keys())
-    for ticker in cached_keys:
+    for ticker in list(cached.keys()):
         if ticker not in mem['data']:
             del cached[ticker]
-            if ticker == last_forecast:
-                figure['layout']['annotations'] = []
-                last_forecast = ''
 
+    # Smoothing and kernel are inputs to every call, not just the ones
+    # they triggered. Sessions aren't sticky, so this worker may hold
+    # series from before they last changed
+    load_many(cached, list(cached), smooth, kernel)
+    for series in cached.values():
+        series.smooth = smooth
+
+    if last_forecast not in mem['data']:
+        last_forecast = ''
+
+    # Comparing: prices become returns and derivatives are relative to
+    # the benchmark. Only tickers new to the comparison are computed
+    drawn, compared = cached, ''
+    if benchmark and benchmark in mem['data']:
+        if load_series(cached, benchmark, smooth, kernel).found:
+            drawn = compare.relative(sid, cached, benchmark)
+            compared = benchmark
+
+    delta = trace_delta(drawn, last_forecast, smooth, kernel, versions, compared)
+    return delta, new_sid, last_forecast
+
+def load_series(cached, ticker, smooth, kernel='none'):
+    '''
+    Fetches the ticker into the session cache if it isn't there yet
+    (first time seeing it, or the session was evicted from the store),
+    or was loaded for another kernel
+    '''
+    if ticker not in cached or cached[ticker].kernel != kernel:
+        table = q.get_table(ticker, kernel=kernel)
+        cache_series(cached, ticker, table, smooth, kernel)
+
+    return cached[ticker]
+
+def load_many(cached, tickers, smooth, kernel='none'):
+    '''
+    Same as load_series, but missing tickers are all fetched at once
+    '''
+    missing = list(set(
+        t for t in tickers if t not in cached or cached[t].kernel != kernel
+    ))
+    if len(missing) == 1:
+        load_series(cached, missing[0], smooth, kernel)
+    elif missing:
+        for ticker, table in q.get_table_many(missing, kernel=kernel).items():
+            cache_series(cached, ticker, table, smooth, kernel)
+
+def cache_series(cached, ticker, table, smooth, kernel='none'):
+    if table is None:
+        cached[ticker] = Series.missing(ticker, kernel)
+    else:
+        cached[ticker] = Series(ticker, table, smooth, kernel)
+
+def trace_delta(cached, forecast, smooth, kernel, versions, benchmark=''):
+    '''
+    Changes to the browser's trace-cache: the names of every trace that
+    should be drawn, in order, and the data for just the ones it doesn't
+    have yet (or has for another smoothing). The zero-crossings are only
+    sent when the forecast ticker, smoothing, kernel or benchmark changes
+    '''
+    versions = versions or dict()
+    names, add = [], []
+
+    for ticker, series in cached.items():
+        if not series.found:
+            continue
+
+        for d in series.shown:
+            name = ticker + ':' + str(d)
+            names.append(name)
+
+            if versions.get(name) != series.version(d):
+                add.append(get_series(series, d))
+                add[-1]['version'] = series.version(d)
+
+    delta = {
+        'names': names,
+        'add': add,
+        'windows': {str(k): days for k, days in time_map.items()},
+        'max_arrows': MAX_ARROWS
+    }
+
+    zeros_version = '%s:%d:%s:%s' % (forecast, smooth, kernel, benchmark)
+    if versions.get('zeros') != zeros_version:
+        delta['zeros'] = get_arrows(cached[forecast]) if forecast in cached else None
+        delta['zeros_version'] = zeros_version
+
+    return delta
+
+def get_arrows(series):
+    '''
+    Every zero-crossing of the second derivative, at each level the
+    second derivative is drawn from (see get_series), so the arrows sit
+    where the drawn trace crosses zero. The browser picks the top
+    MAX_ARROWS for whichever window is showing
+    '''
+    if not series.found:
+        return None
+
+    indexes = [
+        (level, series.trace(2, level)[0]) for level in reversed(series.levels)
+    ]
+    windows = {str(dif): get_level(dif, indexes)[0] for dif in [ALL_Y] + list(time_map)}
+
+    levels = dict()
+    for level in set(windows.values()):
+        zeros = series.zeros(level)
+        levels[level] = encode_zeros(zeros.prev, zeros.dates, zeros.mags)
+
+    return {'windows': windows, 'levels': levels}
+
+def encode_zeros(prev, dates, mags):
     return {
-        'data': figure['data'], 
-        'layout': figure['layout']
-    }, cached, last_forecast
-
-def get_arrows(second_d, span):
-    start = get_delta(span)
-    return q.find_zeros(*second_d, time_cutoff=start)
-
-def get_series(xy, ticker, deriv, span):
-    #if deriv == '3':
-    #    fig['layout']['annotatons'] = xy
-
-    x,y = xy[0], xy[1]
-    start = get_delta(span)
-
-    # Cant trust dataframes to stay that datatype
-    # have to convert back every time :(
-    if start != None:
-        df = pd.DataFrame({'y':y}, index=pd.to_datetime(x))
-        sliced = df[start:]
-        x, y = sliced.index, sliced['y'].array
-
-    return go.Scatter(
-        x=x, y=y, 
-        name=ticker + ':' + str(deriv), 
-        customdatasrc=ticker,
-        yaxis='y' if int(deriv)==0 else 'y2'
-    )
+        'prev': encode_dates(prev),
+        'x': encode_dates(dates),
+        'mag': encode(mags, '<f8')
+    }
+
+def get_series(series, deriv):
+    '''
+    Each window is drawn from the coarsest price level that still fills
+    the chart, so only those levels are sent, each from where the
+    earliest window using it starts. windows says which one to use
+    '''
+    indexes = [
+        (level, series.trace(deriv, level)[0]) for level in reversed(series.levels)
+    ]
 
+    windows, starts = dict(), dict()
+    for dif in time_map:
+        level, i = get_level(dif, indexes)
+        windows[str(dif)] = level
+        starts[level] = min(i, starts.get(level, i))
+
+    levels = dict()
+
+    # Only a very long history has more bars than the graph has pixels
+    # even at the coarsest level. Then 'All' gets its own thinned out
+    # copy and the shorter windows keep every bar
+    level = get_level(ALL_Y, indexes)[0]
+    xy = series.trace(deriv, level)
+    if len(xy[0]) > MAX_POINTS:
+        x, y = downsample(xy[0], xy[1], keep_zeros=deriv > 0)
+        levels['all'] = {'x': encode_dates(x), 'y': encode(y)}
+        level = 'all'
+    else:
+        starts[level] = 0
+
+    windows[str(ALL_Y)] = level
+
+    for level, i in starts.items():
+        # Binary search into the sorted index, x and y stay views
+        xy = series.trace(deriv, level)
+        levels[level] = {'x': encode_dates(xy[0][i:]), 'y': encode(xy[1][i:])}
+
+    return {
+        'name': series.ticker + ':' + str(deriv),
+        'yaxis': 'y' if deriv == 0 else 'y2',
+        # Compared prices are drawn as the return since the window started
+        'rebase': deriv == 0 and isinstance(series, compare.Relative),
+        'windows': windows,
+        'levels': levels
+    }
+
+
+# Merges trace-delta into trace-cache and redraws the figure for the
+# selected window, entirely in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='graph', function_name='render'),
+    [
+        Output('live-graph', 'figure'),
+        Output('trace-cache', 'data'),
+        Output('trace-versions', 'data')
+    ],
+    [
+        Input('trace-delta', 'data'),
+        Input('date_range', 'value'),
+        Input('live-delta', 'data')
+    ],
+    [
+        State('trace-cache', 'data'),
+        State('live-graph', 'figure')
+    ]
+)
 
 @app.callback(
-    Output('forecast', 'options'),
+    Output('live-interval', 'disabled'),
+    Input('live', 'value')
+)
+@metrics.timed(metrics.callback_seconds, callback='toggle_live')
+def toggle_live(live_on):
+    return not live_on
+
+@app.callback(
+    [
+        Output('live-delta', 'data'),
+        Output('live-cursor', 'data')
+    ],
+    [
+        Input('live-interval', 'n_intervals'),
+        Input('live', 'value')
+    ],
+    [
+        State({'type': 'derivatives', 'index': ALL}, 'value'),
+        State('rolling-avg', 'value'),
+        State('kernel', 'value'),
+        State('forecast', 'value'),
+        State('live-cursor', 'data')
+    ],
+    prevent_initial_call=True
+)
+@metrics.timed(metrics.callback_seconds, callback='update_live')
+def update_live(_, live_on, derivs, smooth, kernel, forecast, cursor):
+    '''
+    Polls the feed of every ticker on the graph and sends the bars each
+    trace doesn't have yet. Derivatives and zero-crossings are updated
+    as the bars come in (see live.LiveDeriv), so a tick costs the same
+    however much history is buffered
+    '''
+    if not live_on:
+        return None, dict()
+
+    if smooth is None:
+        raise PreventUpdate
+
+    smooth = int(smooth)
+    kernel = kernel or 'none'
+    cursor = cursor or dict()
+
+    shown = {
+        str(child['id']['index']): [int(v) for v in child['value'] or []]
+        for child in dash.callback_context.states_list[0]
+    }
+
+    tickers = list(shown) + ([forecast] if forecast and forecast not in shown else [])
+    streams = {t: live.streams.get(t) for t in tickers}
+    list(q.pool.map(lambda stream: stream.poll(), streams.values()))
+
+    names, add = [], []
+    new_cursor = {'names': names}
+    for ticker, derivs in shown.items():
+        stream = streams[ticker]
+        if not stream.found:
+            continue
+
+        for d in derivs:
+            name = ticker + ':' + str(d)
+            names.append(name)
+
+            # Derivatives start over if the smoothing or kernel changed
+            # since the last tick, the price doesn't depend on them
+            version = '%d:%s' % (smooth, kernel) if d > 0 else 0
+            have, last = cursor.get(name, [None, None])
+            after = np.datetime64(last, 'ms') if have == version and last is not None else None
+            x, y, reset = stream.trace(d, smooth, after, kernel)
+
+            if len(x) or reset:
+                add.append({
+                    'name': name,
+                    'yaxis': 'y' if d == 0 else 'y2',
+                    'reset': reset,
+                    'x': encode_dates(x),
+                    'y': encode(y)
+                })
+                last = int(x[-1].astype('datetime64[ms]').astype(np.int64)) if len(x) else None
+
+            new_cursor[name] = [version, last]
+
+    delta = {
+        'names': names,
+        'add': add,
+        'size': live.LIVE_BARS,
+        'max_arrows': MAX_ARROWS
+    }
+
+    if forecast in streams and streams[forecast].found:
+        stream = streams[forecast]
+        new_cursor['zeros'] = [forecast, smooth, kernel, stream.zeros_version(smooth, kernel)]
+        if cursor.get('zeros') != new_cursor['zeros']:
+            delta['zeros'] = encode_zeros(*stream.zeros(smooth, kernel))
+    elif cursor.get('zeros'):
+        delta['zeros'] = None
+
+    if not add and 'zeros' not in delta and names == cursor.get('names'):
+        raise PreventUpdate
+
+    return delta, new_cursor
+
+@app.callback(
+    [
+        Output('forecast', 'options'),
+        Output('benchmark', 'options')
+    ],
     Input('memory', 'data'),
     State('forecast', 'options')
 )
+@metrics.timed(metrics.callback_seconds, callback='update_forecast_options')
 def update_forecast_options(mem, options):
     opts = [{'label': 'None', 'value': ''}]
     for m in mem['data']:
@@ -429,7 +737,7 @@ def update_forecast_options(mem, options):
             {'label': m, 'value': m}
         )
     
-    return opts 
+    return opts, opts
 
 @app.callback(
     [
@@ -442,6 +750,7 @@ def update_forecast_options(mem, options):
         State('search-text', 'value')
     ]
 )
+@metrics.timed(metrics.callback_seconds, callback='update_memory')
 def update_memory(_, mem, ticker):
     ctx = dash.callback_context.triggered
 
@@ -484,6 +793,7 @@ def update_memory(_, mem, ticker):
     ],
     prevent_initial_call=True
 )
+@metrics.timed(metrics.callback_seconds, callback='add_or_del_security')
 def add_or_del_security(_, d, text, children, mem):
     ctx = dash.callback_context.triggered[0]
     pid = ctx['prop_id']
@@ -516,10 +826,9 @@ def add_new_stock(ticker, component):
         ),
         dcc.Checklist(
                 id={'type': 'derivatives', 'index': ticker},
-                options=[
-                    {'label': 'Base Price\n', 'value': 0},
-                    {'label': 'd/dx', 'value': 1},
-                    {'label': 'd^2/dx', 'value': 2}
+                options=[{'label': 'Base Price\n', 'value': 0}] + [
+                    {'label': 'd/dx' if k == 1 else 'd^%d/dx' % k, 'value': k}
+                    for k in range(1, q.MAX_ORDER+1)
                 ],
                 value=[],
                 style={'text-align': 'center'}
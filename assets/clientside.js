@@ -0,0 +1,279 @@
+// Clientside callbacks. Dash loads everything in assets/ on its own.
+
+// First position in the sorted array xs that's >= x
+function lowerBound(xs, x) {
+    var lo = 0, hi = xs.length;
+    while (lo < hi) {
+        var mid = (lo + hi) >>> 1;
+        if (xs[mid] < x) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo;
+}
+
+// Inverse of codec.encode: base64 -> typed array over the same bytes
+var TYPED = {'<f4': Float32Array, '<f8': Float64Array, '<i4': Int32Array};
+
+function decode(enc) {
+    var raw = atob(enc.data);
+    var bytes = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+
+    var Type = TYPED[enc.dtype];
+    return new Type(bytes.buffer, 0, bytes.length / Type.BYTES_PER_ELEMENT);
+}
+
+// Inverse of codec.encode_dates, as ms since the epoch
+function decodeDates(enc) {
+    var offsets = decode(enc.offsets);
+    var ms = new Float64Array(offsets.length);
+    for (var i = 0; i < offsets.length; i++) ms[i] = enc.start + offsets[i] * enc.unit;
+    return ms;
+}
+
+// Decoded arrays for each trace version, so a slider move never decodes
+var decoded = {};
+
+function decodeTrace(t) {
+    var key = t.name + '@' + t.version;
+    if (!(key in decoded)) {
+        decoded[key] = {};
+        Object.keys(t.levels).forEach(function(level) {
+            var l = t.levels[level];
+            decoded[key][level] = {x: decodeDates(l.x), y: decode(l.y)};
+        });
+    }
+    return decoded[key];
+}
+
+var decodedZeros = {version: null, levels: {}};
+
+// Crossings at the level the window's second derivative is drawn from
+function decodeZeros(zeros, version, dateRange) {
+    if (!zeros) return null;
+    if (decodedZeros.version !== version) {
+        decodedZeros = {version: version, levels: {}};
+    }
+
+    var level = zeros.windows[String(dateRange)];
+    if (!(level in decodedZeros.levels)) {
+        var z = zeros.levels[level];
+        decodedZeros.levels[level] = {
+            prev: decodeDates(z.prev),
+            x: decodeDates(z.x),
+            mag: decode(z.mag)
+        };
+    }
+    return decodedZeros.levels[level];
+}
+
+// The max_arrows biggest crossings that happened after cutoff, scaled by
+// the biggest one. backtest.py's crossings normalizes the same way
+function arrows(zeros, cutoff, maxArrows) {
+    if (!zeros) return [];
+
+    var start = cutoff === null ? 0 : lowerBound(zeros.prev, cutoff);
+    var n = zeros.mag.length - start;
+    if (n <= 0) return [];
+
+    var peak = 0;
+    for (var i = start; i < zeros.mag.length; i++) {
+        peak = Math.max(peak, Math.abs(zeros.mag[i]));
+    }
+
+    var mags = new Array(n), order = new Array(n);
+    for (var i = 0; i < n; i++) {
+        mags[i] = zeros.mag[start + i] / (peak || 1);
+        order[i] = i;
+    }
+    order.sort(function(a, b) { return Math.abs(mags[b]) - Math.abs(mags[a]); });
+
+    return order.slice(0, maxArrows).map(function(i) {
+        var x = zeros.x[start + i];
+        return {
+            // Which way it crossed, same as the backtester's side
+            arrowcolor: zeros.mag[start + i] > 0 ? 'green' : 'red',
+            x: x, y: mags[i],
+            xref: 'x', yref: 'y2',
+            text: '',
+            showarrow: true,
+            axref: 'x', ayref: 'y2',
+            ax: x, ay: 0,
+            arrowhead: 3,
+            arrowwidth: 1.5
+        };
+    });
+}
+
+// Prices as the return since the first one
+function rebase(y) {
+    var out = new Float32Array(y.length);
+    for (var i = 0; i < y.length; i++) out[i] = y[i] / y[0] - 1;
+    return out;
+}
+
+// Applies a trace-delta from update_graph to the trace-cache
+function merge(cache, delta) {
+    cache = cache || {traces: {}, names: [], zeros: null, versions: {}};
+    if (!delta) return cache;
+
+    var traces = {}, versions = {};
+    delta.names.forEach(function(name) {
+        if (cache.traces[name]) {
+            traces[name] = cache.traces[name];
+            versions[name] = cache.versions[name];
+        }
+    });
+    delta.add.forEach(function(t) {
+        traces[t.name] = t;
+        versions[t.name] = t.version;
+    });
+
+    var merged = {
+        traces: traces,
+        names: delta.names,
+        zeros: cache.zeros,
+        versions: versions,
+        windows: delta.windows,
+        max_arrows: delta.max_arrows
+    };
+
+    if ('zeros' in delta) merged.zeros = delta.zeros;
+    versions.zeros = 'zeros_version' in delta ? delta.zeros_version : cache.versions.zeros;
+
+    return merged;
+}
+
+// a then b in one typed array, keeping at most the last size values
+function concat(a, b, size) {
+    var out = new a.constructor(a.length + b.length);
+    out.set(a);
+    out.set(b, a.length);
+    return out.length > size ? out.subarray(out.length - size) : out;
+}
+
+// What live mode is showing, null when it's off
+var live = null;
+
+// Appends a live-delta from update_live to the live traces
+function mergeLive(delta) {
+    if (!delta) return null;
+
+    var prev = live || {traces: {}, zeros: null};
+    var traces = {};
+    delta.names.forEach(function(name) {
+        if (prev.traces[name]) traces[name] = prev.traces[name];
+    });
+    delta.add.forEach(function(t) {
+        var x = decodeDates(t.x), y = decode(t.y);
+        var old = traces[t.name];
+        if (old && !t.reset) {
+            x = concat(old.x, x, delta.size);
+            y = concat(old.y, y, delta.size);
+        }
+        traces[t.name] = {x: x, y: y, yaxis: t.yaxis};
+    });
+
+    var zeros = prev.zeros;
+    if ('zeros' in delta) {
+        zeros = delta.zeros && {
+            prev: decodeDates(delta.zeros.prev),
+            x: decodeDates(delta.zeros.x),
+            mag: decode(delta.zeros.mag)
+        };
+    }
+
+    return {traces: traces, names: delta.names, zeros: zeros, max_arrows: delta.max_arrows};
+}
+
+function renderLive(layout) {
+    var data = live.names.filter(function(name) {
+        return name in live.traces;
+    }).map(function(name) {
+        var t = live.traces[name];
+        return {type: 'scatter', x: t.x, y: t.y, name: name, yaxis: t.yaxis};
+    });
+
+    // The whole buffer is drawn whatever the date_range is
+    return {
+        data: data,
+        layout: Object.assign({}, layout, {
+            annotations: arrows(live.zeros, null, live.max_arrows)
+        })
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    graph: {
+        // Merges in whatever update_graph sent and draws the result for
+        // the selected time window, or the live traces while live mode is on
+        render: function(delta, dateRange, liveDelta, cache, figure) {
+            var triggered = window.dash_clientside.callback_context.triggered;
+            var from = function(id) {
+                return triggered.some(function(t) { return t.prop_id === id; });
+            };
+            var fromServer = from('trace-delta.data');
+            var noUpdate = window.dash_clientside.no_update;
+
+            if (fromServer) cache = merge(cache, delta);
+            if (from('live-delta.data')) live = mergeLive(liveDelta);
+
+            if (live) {
+                return [
+                    renderLive(figure.layout),
+                    fromServer ? cache : noUpdate,
+                    fromServer ? cache.versions : noUpdate
+                ];
+            }
+
+            if (!cache || !cache.windows) throw window.dash_clientside.PreventUpdate;
+
+            var days = cache.windows[String(dateRange)];
+            var cutoff = days === undefined ? null : Date.now() - days * 864e5;
+
+            var names = cache.names.filter(function(name) {
+                return name in cache.traces;
+            });
+
+            var keep = {};
+            var data = names.map(function(name) {
+                var t = cache.traces[name];
+                var arr = decodeTrace(t)[t.windows[String(dateRange)]];
+                keep[t.name + '@' + t.version] = true;
+
+                // subarray is a view, nothing gets copied
+                var x = arr.x, y = arr.y;
+                if (cutoff !== null) {
+                    var i = lowerBound(x, cutoff);
+                    x = x.subarray(i);
+                    y = y.subarray(i);
+                }
+                if (t.rebase) y = rebase(y);
+
+                return {
+                    type: 'scatter',
+                    x: x, y: y,
+                    name: t.name,
+                    yaxis: t.yaxis
+                };
+            });
+
+            Object.keys(decoded).forEach(function(key) {
+                if (!keep[key]) delete decoded[key];
+            });
+
+            var layout = Object.assign({}, figure.layout, {
+                annotations: arrows(
+                    decodeZeros(cache.zeros, cache.versions.zeros, dateRange),
+                    cutoff, cache.max_arrows
+                )
+            });
+
+            return [
+                {data: data, layout: layout},
+                fromServer ? cache : noUpdate,
+                fromServer ? cache.versions : noUpdate
+            ];
+        }
+    }
+});
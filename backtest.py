@@ -0,0 +1,214 @@
+'''
+Backtests the forecast arrows as a trading signal: buy on a green arrow,
+sell on the next red one.
+
+    python backtest.py SPY QQQ --smooth 2 4 8 --max-arrows 25 0
+    python backtest.py --universe sp500.txt --threshold 0 0.5 --workers 8
+
+Every combination of ticker, smooth, max_arrows and threshold is a cell.
+max_arrows keeps only the biggest crossings like the graph does (0 keeps
+all of them) and threshold drops arrows shorter than that. As on the
+graph, which arrows are biggest is decided over the whole history, so
+max_arrows results are in-sample.
+
+Prices are loaded once into shared memory and the cells are spread over
+a process pool; within a cell, positions and returns are plain numpy.
+'''
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import queries as q
+import screener
+
+WORKERS = int(os.environ.get('BACKTEST_WORKERS', os.cpu_count() or 1))
+
+METRICS = ['total_return', 'buy_hold', 'max_drawdown', 'hit_rate', 'trades', 'exposure']
+
+def crossings(idx, close, open, smooth):
+    '''
+    Bar index, normalized magnitude and direction (1 up, -1 down) of
+    every zero-crossing of the second derivative. Magnitudes are
+    normalized the same way the graph's arrows are (arrows() in
+    assets/clientside.js)
+    '''
+    offset = max(1, int(smooth*5))
+    dd = q.derivatives(idx, close, open, smooth, order=2)[1][1]
+
+    gt = dd > 0
+    cross = np.flatnonzero(np.logical_xor(gt[1:], gt[:-1])) + 1
+    if not cross.shape[0]:
+        return cross, np.empty(0), np.empty(0)
+
+    mags = dd[cross] - dd[cross-1]
+    norm = mags / (np.abs(mags).max() or 1)
+
+    return cross + 2*offset, norm, np.where(mags > 0, 1, -1)
+
+def arrows(norm, max_arrows, threshold):
+    '''
+    Which crossings would be drawn
+    '''
+    keep = np.abs(norm) >= threshold
+    if max_arrows and max_arrows < norm.shape[0]:
+        top = np.zeros(norm.shape[0], dtype=bool)
+        top[np.argpartition(np.abs(norm), -max_arrows)[-max_arrows:]] = True
+        keep &= top
+
+    return keep
+
+def evaluate(close, at, side):
+    '''
+    Long from the bar after each buy (side 1) until the bar after the
+    next sell (side -1), flat otherwise
+    '''
+    n = close.shape[0]
+
+    signal = np.zeros(n)
+    signal[at] = side
+
+    # Latest signal at or before every bar, 0 before the first one
+    last = np.maximum.accumulate(np.where(signal != 0, np.arange(n), 0))
+    state = signal[last]
+
+    held = np.zeros(n)
+    held[1:] = state[:-1] > 0
+
+    ret = np.zeros(n)
+    ret[1:] = close[1:] / close[:-1] - 1
+    equity = np.cumprod(1 + held*ret)
+
+    # Round trips, an open one is closed at the last bar
+    edges = np.diff(np.concatenate([[0], held, [0]]))
+    entries = np.flatnonzero(edges == 1)
+    exits = np.flatnonzero(edges == -1)
+    trades = equity[exits-1] / equity[entries-1] - 1
+
+    return {
+        'total_return': float(equity[-1] - 1),
+        'buy_hold': float(close[-1] / close[0] - 1),
+        'max_drawdown': float(np.max(1 - equity / np.maximum.accumulate(equity))),
+        'hit_rate': float((trades > 0).mean()) if trades.shape[0] else float('nan'),
+        'trades': int(trades.shape[0]),
+        'exposure': float(held.mean())
+    }
+
+def run_ticker(dates, close, open, smooth, grid):
+    '''
+    Every (max_arrows, threshold) in grid for one ticker and smooth.
+    The crossings are found once and shared by all of them
+    '''
+    # Drop the left padding from screener.load
+    known = np.isfinite(close)
+    start = np.argmax(known) if known.any() else close.shape[0]
+    dates, close, open = dates[start:], close[start:], open[start:]
+
+    if close.shape[0] < 2:
+        return [None for _ in grid]
+
+    at, norm, side = crossings(dates, close, open, smooth)
+
+    return [
+        evaluate(close, at[keep], side[keep])
+        for keep in (arrows(norm, m, t) for m, t in grid)
+    ]
+
+# Prices of every ticker, in shared memory once the pool is running
+_prices = dict()
+
+def attach(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    _prices['shm'] = shm
+    _prices['arrays'] = views(shm.buf, shape)
+
+def views(buf, shape):
+    '''
+    dates, close and open laid out back to back in buf
+    '''
+    size = shape[0] * shape[1] * 8
+    return [
+        np.ndarray(shape, dtype=dtype, buffer=buf, offset=i*size)
+        for i, dtype in enumerate(['datetime64[ns]', np.float64, np.float64])
+    ]
+
+def run_task(task):
+    row, smooth, grid = task
+    dates, close, open = _prices['arrays']
+    return run_ticker(dates[row], close[row], open[row], smooth, grid)
+
+def backtest(tickers, smooths=(4,), max_arrows=(25,), thresholds=(0,), period='max', workers=WORKERS):
+    '''
+    One dict per cell of the grid with the ticker, parameters and METRICS
+    '''
+    tickers, dates, close, open = screener.load(tickers, period=period)
+    grid = [(m, t) for m in max_arrows for t in thresholds]
+    tasks = [(row, s, grid) for row in range(len(tickers)) for s in smooths]
+
+    if workers <= 1 or len(tasks) < 2:
+        _prices['arrays'] = [dates, close, open]
+        results = [run_task(task) for task in tasks]
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 3 * dates.size * 8))
+        try:
+            for dst, src in zip(views(shm.buf, dates.shape), [dates, close, open]):
+                dst[:] = src
+
+            with ProcessPoolExecutor(
+                min(workers, len(tasks)), initializer=attach,
+                initargs=(shm.name, dates.shape)
+            ) as pool:
+                results = list(pool.map(run_task, tasks))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    ret = []
+    for (row, smooth, _), cells in zip(tasks, results):
+        for (m, t), cell in zip(grid, cells):
+            if cell is not None:
+                ret.append(dict(ticker=tickers[row], smooth=smooth, max_arrows=m, threshold=t, **cell))
+
+    return ret
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('tickers', nargs='*')
+    ap.add_argument('--universe', help='file with one ticker per line')
+    ap.add_argument('--smooth', type=float, nargs='+', default=[4])
+    ap.add_argument('--max-arrows', type=int, nargs='+', default=[25])
+    ap.add_argument('--threshold', type=float, nargs='+', default=[0])
+    ap.add_argument('--period', default='max')
+    ap.add_argument('--workers', type=int, default=WORKERS)
+    ap.add_argument('--sort', choices=METRICS, default='total_return')
+    ap.add_argument('--top', type=int, default=50)
+    args = ap.parse_args()
+
+    tickers = args.tickers or screener.universe()
+    if args.universe:
+        with open(args.universe) as f:
+            tickers = [l.strip() for l in f if l.strip()]
+
+    cells = backtest(
+        tickers, args.smooth, args.max_arrows, args.threshold,
+        period=args.period, workers=args.workers
+    )
+    if not cells:
+        print('No data')
+        sys.exit(1)
+
+    cells.sort(key=lambda cell: -np.nan_to_num(cell[args.sort], nan=-np.inf))
+
+    print('%-8s %6s %6s %6s %10s %10s %8s %6s %6s %6s' % (
+        'ticker', 'smooth', 'arrows', 'thresh', 'return', 'buy&hold', 'drawdown', 'hits', 'trades', 'in'))
+    for cell in cells[:args.top]:
+        print('%-8s %6g %6d %6g %9.1f%% %9.1f%% %7.1f%% %5.0f%% %6d %5.0f%%' % (
+            cell['ticker'], cell['smooth'], cell['max_arrows'], cell['threshold'],
+            cell['total_return']*100, cell['buy_hold']*100, cell['max_drawdown']*100,
+            cell['hit_rate']*100, cell['trades'], cell['exposure']*100))
+
+if __name__ == '__main__':
+    main()
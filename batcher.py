@@ -0,0 +1,201 @@
+import os
+import time
+import threading
+
+import numpy as np
+
+import metrics
+from providers import Provider
+
+# How long a request waits for others to share its upstream download (ms)
+BATCH_WINDOW = float(os.environ.get('FETCH_BATCH_WINDOW', 25))
+
+# Most tickers sent upstream in one download
+BATCH_MAX = int(os.environ.get('FETCH_BATCH_MAX', 100))
+
+# Upstream downloads per second, and how many can go out back to back
+# after a quiet spell. A rate of 0 never waits
+FETCH_RATE = float(os.environ.get('FETCH_RATE', 2))
+FETCH_BURST = int(os.environ.get('FETCH_BURST', 5))
+
+
+class TokenBucket:
+    def __init__(self, rate=FETCH_RATE, burst=FETCH_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''
+        Blocks until there's a token to spend
+        '''
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+# Shared by every upstream path in the worker, daily history and live bars
+shared_bucket = TokenBucket()
+
+
+class Request:
+    def __init__(self, ticker, period, start):
+        self.ticker = ticker
+        self.period = period
+        self.start = start
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    @property
+    def group(self):
+        # Requests for a period can share a download with the same period,
+        # requests from a date can share one from the earliest date
+        return ('period', self.period) if self.start is None else ('start',)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class BatchingProvider(Provider):
+    '''
+    Wraps a provider so that histories asked for by different threads
+    within BATCH_WINDOW of each other go upstream as one history_many
+    download. Downloads are spaced out by a token bucket, and whatever
+    comes in while one is waiting for a token joins it, so the busier
+    it gets the fewer requests upstream sees
+    '''
+    def __init__(self, provider, window=BATCH_WINDOW, max_batch=BATCH_MAX, bucket=None, source='history'):
+        self.provider = provider
+        self.source = source
+        self.window = window
+        self.max_batch = max_batch
+        self.bucket = shared_bucket if bucket is None else bucket
+
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, tickers, period, start):
+        reqs = [Request(t.upper(), period, start) for t in tickers]
+
+        with self.cond:
+            self.pending.extend(reqs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+        return reqs
+
+    def history(self, ticker, period='max', start=None):
+        return self.submit([ticker], period, start)[0].wait()
+
+    def history_many(self, tickers, period='max', start=None):
+        reqs = self.submit(tickers, period, start)
+        return {t: req.wait() for t, req in zip(tickers, reqs)}
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+            time.sleep(self.window / 1000)
+            self.bucket.take()
+
+            with self.cond:
+                batch = self.next_batch()
+
+            self.send(batch)
+
+    def next_batch(self):
+        '''
+        Takes the oldest request and every other pending one that can
+        share its download, up to max_batch distinct tickers
+        '''
+        group = self.pending[0].group
+        tickers = set()
+        batch, rest = [], []
+
+        for req in self.pending:
+            fits = req.ticker in tickers or len(tickers) < self.max_batch
+            if req.group == group and fits:
+                tickers.add(req.ticker)
+                batch.append(req)
+            else:
+                rest.append(req)
+
+        self.pending = rest
+        return batch
+
+    def send(self, batch):
+        tickers = list(dict.fromkeys(req.ticker for req in batch))
+        first = batch[0]
+        start = None if first.start is None else min(req.start for req in batch)
+
+        metrics.fetch_batch_size.observe(len(tickers))
+        try:
+            with metrics.timer(metrics.fetch_seconds, source=self.source):
+                if start is None:
+                    hists = self.provider.history_many(tickers, period=first.period)
+                else:
+                    hists = self.provider.history_many(tickers, start=start)
+        except Exception as e:
+            for req in batch:
+                req.error = e
+                req.done.set()
+            return
+
+        for req in batch:
+            hist = hists.get(req.ticker)
+            if hist is not None and req.start is not None and req.start != start:
+                hist = since(hist, req.start)
+
+            req.result = hist
+            req.done.set()
+
+def since(hist, start):
+    '''
+    hist from start on, None if that leaves nothing
+    '''
+    idx = hist.index
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+
+    hist = hist[np.asarray(idx.values >= np.datetime64(start, 'ns'))]
+    return hist if len(hist) else None
+
+
+_batcher = None
+_lock = threading.Lock()
+
+def batched(provider):
+    '''
+    The BatchingProvider in front of provider, shared by every thread in
+    the worker. A new one is made if the provider is swapped out
+    '''
+    global _batcher
+    with _lock:
+        if _batcher is None or _batcher.provider is not provider:
+            _batcher = BatchingProvider(provider)
+
+        return _batcher
@@ -0,0 +1,248 @@
+'''
+Benchmarks for the queries math and the update_graph callback.
+
+    python bench.py                      # run everything, print a table
+    python bench.py --save base.json     # ... and save the numbers
+    python bench.py --compare base.json  # ... and flag anything slower
+
+Micro benchmarks run on synthetic random walks of 1k bars up to
+--max-bars (10M at most). The end to end ones post the same requests
+the browser would to update_graph, with prices from SyntheticProvider
+and every cache pointed at a throwaway directory. Moving the date_range
+slider never reaches the server, so there's nothing to time for it.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import atexit
+import argparse
+import tempfile
+import tracemalloc
+
+# Has to happen before the app modules read their config
+TMP = tempfile.mkdtemp(prefix='stock_bench_')
+atexit.register(shutil.rmtree, TMP, True)
+os.environ['MARKET_DATA'] = 'synthetic'
+os.environ['HISTORY_CACHE'] = '0'
+os.environ['HISTORY_CACHE_DIR'] = os.path.join(TMP, 'history')
+os.environ['RESULT_CACHE_PATH'] = os.path.join(TMP, 'results.sqlite')
+os.environ['SINGLEFLIGHT_LOCK_DIR'] = os.path.join(TMP, 'locks')
+os.environ['PREFETCH'] = '0'
+
+import numpy as np
+
+import queries as q
+from downsample import downsample
+
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+# Slower than the baseline by more than this counts as a regression
+TOLERANCE = 1.25
+
+def series(n, seed=0):
+    rng = np.random.default_rng(seed)
+    idx = np.arange(
+        np.datetime64('2000-01-01', 'ns'),
+        np.datetime64('2000-01-01', 'ns') + np.timedelta64(n, 'h'),
+        np.timedelta64(1, 'h')
+    )
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    open = close * (1 + rng.normal(0, 0.002, n))
+    return idx, close, open
+
+def measure(fn, repeat):
+    '''
+    Best of repeat runs in seconds, and peak memory of one more run
+    '''
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+def micro(max_bars, repeat):
+    ret = dict()
+    for n in [s for s in SIZES if s <= max_bars]:
+        idx, close, open = series(n)
+        d = q.first(idx, open, close, 4)
+        dd = q.second(*d, 4)
+
+        cases = {
+            'first': lambda: q.first(idx, open, close, 4),
+            'second': lambda: q.second(*d, 4),
+            'zero_index': lambda: q.ZeroIndex(*dd),
+            'smoothing': lambda: q.smoothing(close, 20),
+            'downsample': lambda: downsample(*d, keep_zeros=True),
+        }
+
+        # 53 rows of float32 per bar gets big quickly
+        if n <= 10**6:
+            bars = np.empty((), dtype=q.bar_dtype(n))
+            bars['date'], bars['open'], bars['close'] = idx, open, close
+            table = {'bars': bars}
+            table['derivs'] = q.deriv_table(close, open)
+
+            cases['derivatives'] = lambda: q.derivatives(idx, close, open, 4)
+            cases['deriv_table'] = lambda: q.deriv_table(close, open)
+            cases['lookup'] = lambda: q.lookup(table, 7)
+
+        for name, fn in cases.items():
+            ret['%s/%d' % (name, n)] = measure(fn, repeat if n < 10**6 else 1)
+
+    return ret
+
+def end_to_end(repeat):
+    import app
+
+    client = app.server.test_client()
+    outputs = [
+        {'id': 'trace-delta', 'property': 'data'},
+        {'id': 'graph-cache', 'property': 'data'},
+        {'id': 'last-forecast', 'property': 'data'}
+    ]
+    tickers = ['SPY', 'QQQ', 'AAPL']
+    mem = {'data': tickers}
+
+    state = {'sid': None, 'forecast': '', 'versions': dict()}
+
+    def post(changed, smooth=4, kernel='none', forecast='', benchmark='', values=(0, 1, 2)):
+        payload = {
+            'output': '..trace-delta.data...graph-cache.data...last-forecast.data..',
+            'outputs': outputs,
+            'inputs': [
+                [
+                    {'id': {'type': 'derivatives', 'index': t}, 'property': 'value', 'value': list(values)}
+                    for t in tickers
+                ],
+                {'id': 'rolling-avg', 'property': 'value', 'value': str(smooth)},
+                {'id': 'kernel', 'property': 'value', 'value': kernel},
+                {'id': 'forecast', 'property': 'value', 'value': forecast},
+                {'id': 'benchmark', 'property': 'value', 'value': benchmark}
+            ],
+            'state': [
+                {'id': 'memory', 'property': 'data', 'value': mem},
+                {'id': 'graph-cache', 'property': 'data', 'value': state['sid']},
+                {'id': 'last-forecast', 'property': 'data', 'value': state['forecast']},
+                {'id': 'trace-versions', 'property': 'data', 'value': state['versions']}
+            ],
+            'changedPropIds': changed
+        }
+
+        resp = client.post('/_dash-update-component', json=payload)
+        if resp.status_code == 204:
+            return
+
+        if resp.status_code != 200:
+            raise RuntimeError(resp.data[:500])
+
+        resp = resp.get_json()['response']
+        state['sid'] = resp.get('graph-cache', {}).get('data', state['sid'])
+        state['forecast'] = resp.get('last-forecast', {}).get('data', state['forecast'])
+
+        # What graph.render would remember after merging the delta
+        delta = resp['trace-delta']['data']
+        versions = {n: state['versions'].get(n) for n in delta['names']}
+        versions.update((t['name'], t['version']) for t in delta['add'])
+        versions['zeros'] = delta.get('zeros_version', state['versions'].get('zeros'))
+        state['versions'] = versions
+
+    def trigger(t):
+        return '{"index":"%s","type":"derivatives"}.value' % t
+
+    def add_cold():
+        q.results.clear()
+        q.tables.clear()
+        state['sid'] = None
+        state['versions'] = dict()
+        for t in tickers:
+            post([trigger(t)])
+
+    ret = dict()
+    ret['add_ticker_cold'] = measure(add_cold, 1)
+
+    # Same, but with the tables already warmed by the prefetcher
+    q.results.clear()
+    q.tables.clear()
+    app.prefetch.tracker.hit(tickers, 4)
+    app.prefetch.scheduler.tick()
+
+    def add_prefetched():
+        state['sid'] = None
+        state['versions'] = dict()
+        for t in tickers:
+            post([trigger(t)])
+
+    ret['add_ticker_prefetched'] = measure(add_prefetched, repeat)
+    ret['add_ticker'] = measure(lambda: post([trigger('SPY')]), repeat)
+    ret['rolling_avg'] = measure(lambda: [
+        post(['rolling-avg.value'], smooth=s) for s in (2, 6, 4)
+    ], repeat)
+    ret['kernel'] = measure(lambda: [
+        post(['kernel.value'], kernel=k) for k in ('ema', 'none')
+    ], repeat)
+    ret['forecast'] = measure(lambda: post(['forecast.value'], forecast='SPY'), repeat)
+    ret['compare'] = measure(lambda: [
+        post(['benchmark.value'], benchmark=b) for b in ('SPY', '')
+    ], repeat)
+
+    return {'e2e/' + k: v for k, v in ret.items()}
+
+def report(results, baseline=None):
+    regressions = []
+    print('%-32s %12s %12s %10s' % ('case', 'time (ms)', 'peak (KiB)', 'vs base'))
+
+    for name, (t, peak) in results.items():
+        ratio = ''
+        if baseline and name in baseline:
+            r = t / baseline[name][0]
+            ratio = '%.2fx' % r
+            if r > TOLERANCE:
+                ratio += ' !'
+                regressions.append(name)
+
+        print('%-32s %12.3f %12.1f %10s' % (name, t*1e3, peak/1024, ratio))
+
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--max-bars', type=int, default=10**6)
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--only', choices=['micro', 'e2e'])
+    ap.add_argument('--save')
+    ap.add_argument('--compare')
+    args = ap.parse_args()
+
+    results = dict()
+    if args.only != 'e2e':
+        results.update(micro(args.max_bars, args.repeat))
+    if args.only != 'micro':
+        results.update(end_to_end(args.repeat))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if regressions:
+        print('\nSlower than baseline:', ', '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
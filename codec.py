@@ -0,0 +1,46 @@
+import base64
+import numpy as np
+
+# Every date array is either whole days or, for intraday bars, seconds
+DAY_MS = 24*60*60*1000
+SECOND_MS = 1000
+
+def encode(arr, dtype='<f4'):
+    '''
+    Typed array as base64, e.g. {'dtype': '<f4', 'data': '...'}. float32
+    is plenty for plotting and half the size of float64
+    '''
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    return {
+        'dtype': arr.dtype.str,
+        'data': base64.b64encode(arr.data).decode('ascii')
+    }
+
+def decode(enc):
+    '''
+    Inverse of encode. The array is a read-only view of the decoded bytes
+    '''
+    return np.frombuffer(base64.b64decode(enc['data']), dtype=enc['dtype'])
+
+def encode_dates(idx):
+    '''
+    datetime64 array as a start time and int32 offsets from it, counted
+    in days if every date is midnight, otherwise in seconds. All in ms
+    since the epoch, which is what plotly reads on a date axis
+    '''
+    ms = np.asarray(idx).astype('datetime64[ms]').astype(np.int64)
+    if not len(ms):
+        return {'start': 0, 'unit': DAY_MS, 'offsets': encode([], '<i4')}
+
+    start = int(ms[0])
+    unit = DAY_MS if not (ms % DAY_MS).any() else SECOND_MS
+
+    return {
+        'start': start,
+        'unit': unit,
+        'offsets': encode((ms - start) // unit, '<i4')
+    }
+
+def decode_dates(enc):
+    offsets = decode(enc['offsets']).astype(np.int64)
+    return (enc['start'] + offsets * enc['unit']).astype('datetime64[ms]')
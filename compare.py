@@ -0,0 +1,261 @@
+import os
+import numpy as np
+
+import queries as q
+import kernels
+from series_store import SeriesStore
+
+# Bars in each rolling correlation
+CORR_WINDOW = int(os.environ.get('CORR_WINDOW', 60))
+
+def align(idx, bars):
+    '''
+    (close, open) of bars on the dates in idx: each date gets the last
+    bar on or before it, NaN before the first one. One searchsorted for
+    the whole column
+    '''
+    pos = np.searchsorted(bars['date'], idx, side='right') - 1
+    missing = pos < 0
+    pos[missing] = 0
+
+    close, open = bars['close'][pos], bars['open'][pos]
+    close[missing] = open[missing] = np.nan
+
+    return close, open
+
+def rolling_sum(a, window):
+    cs = np.concatenate([[0], np.cumsum(a)])
+    out = np.full(a.shape, np.nan)
+    out[window-1:] = cs[window:] - cs[:-window]
+    return out
+
+def rolling_corr(x, y, window):
+    '''
+    Correlation of x and y over the last window bars at every bar, NaN
+    until there's a full window of bars where both are known
+    '''
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = np.where(valid, x, 0), np.where(valid, y, 0)
+
+    n = rolling_sum(valid.astype(float), window)
+    sx, sy = rolling_sum(x, window), rolling_sum(y, window)
+
+    # n is 0 (or NaN) wherever the window runs over the padding
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = rolling_sum(x*y, window) - sx*sy/n
+        vx = rolling_sum(x*x, window) - sx*sx/n
+        vy = rolling_sum(y*y, window) - sy*sy/n
+        corr = cov / np.sqrt(vx*vy)
+
+    corr[n < window] = np.nan
+    return corr
+
+
+class Comparison:
+    '''
+    Tickers lined up on the benchmark's trading days. Each ticker is a
+    column that's computed once when it's added: its aligned prices,
+    its rolling correlation with every column already there, and its
+    derivatives relative to the benchmark. Adding or dropping a ticker
+    never touches the other columns
+    '''
+    def __init__(self, benchmark, table, window=CORR_WINDOW):
+        self.benchmark = benchmark
+        self.idx = table['bars']['date']
+        self.window = window
+
+        self.tables = dict()
+        self.columns = dict()
+        self.returns = dict()
+        self.corr = dict()
+        self.relative = dict()
+
+        self.add(benchmark, table)
+
+    def add(self, ticker, table):
+        # Columns are rebuilt if the ticker's table has since been
+        # recomputed with new bars
+        if self.tables.get(ticker) is table:
+            return
+        self.drop(ticker)
+
+        close, open = align(self.idx, table['bars'])
+
+        r = np.full(close.shape, np.nan)
+        r[1:] = np.log(close[1:] / close[:-1])
+
+        for other in self.columns:
+            self.corr[(other, ticker)] = rolling_corr(self.returns[other], r, self.window)
+
+        self.tables[ticker] = table
+        self.columns[ticker] = (close, open)
+        self.returns[ticker] = r
+
+    def drop(self, ticker):
+        if ticker == self.benchmark:
+            return
+
+        self.tables.pop(ticker, None)
+        self.columns.pop(ticker, None)
+        self.returns.pop(ticker, None)
+        for key in [k for k in self.corr if ticker in k]:
+            del self.corr[key]
+        for key in [k for k in self.relative if k[0] == ticker]:
+            del self.relative[key]
+
+    def start(self, ticker):
+        '''
+        Position of the ticker's first bar on the shared index
+        '''
+        known = np.isfinite(self.columns[ticker][0])
+        return int(np.argmax(known)) if known.any() else known.shape[0]
+
+    def correlation(self, a, b):
+        if a == b:
+            return np.where(np.isfinite(self.returns[a]), 1.0, np.nan)
+
+        return self.corr[(a, b)] if (a, b) in self.corr else self.corr[(b, a)]
+
+    def matrix(self, tickers=None, at=-1):
+        '''
+        Correlation of every pair of tickers over the window ending at
+        position at
+        '''
+        tickers = list(self.columns) if tickers is None else tickers
+        return np.array([[self.correlation(a, b)[at] for b in tickers] for a in tickers])
+
+    def normalized(self, ticker, start=0):
+        '''
+        Close as a return since the first bar at or after position start
+        '''
+        close = self.columns[ticker][0][start:]
+        base = close[max(start, self.start(ticker)) - start] if close.shape[0] else np.nan
+        return close / base - 1
+
+    def relative_derivs(self, ticker, smooth, kernel='none'):
+        '''
+        Every derivative of the ticker's prices divided by the
+        benchmark's, from the ticker's first bar on. The ratio is what
+        gets smoothed, same as the prices are outside of compare mode
+        '''
+        key = (ticker, smooth, kernel)
+        if key not in self.relative:
+            if len(self.relative) > 256:
+                self.relative.clear()
+
+            i = self.start(ticker)
+            close, open = self.columns[ticker]
+            bench_close, bench_open = self.columns[self.benchmark]
+
+            close = kernels.apply(close[i:] / bench_close[i:], kernel)
+            open = kernels.apply(open[i:] / bench_open[i:], kernel)
+            self.relative[key] = q.derivatives(self.idx[i:], close, open, smooth)
+
+        return self.relative[key]
+
+    def relative_zeros(self, ticker, smooth, kernel='none'):
+        '''
+        ZeroIndex of the relative second derivative, so the arrows sit
+        where the drawn trace crosses zero
+        '''
+        key = (ticker, smooth, kernel, 'zeros')
+        if key not in self.relative:
+            derivs = self.relative_derivs(ticker, smooth, kernel)
+            self.relative[key] = q.ZeroIndex(*derivs[1])
+
+        return self.relative[key]
+
+
+class Relative:
+    '''
+    Stands in for a Series while comparing: the price trace is the close
+    (the browser rebases it to a return for each window) and the
+    derivatives are relative to the benchmark
+    '''
+    levels = ['daily']
+
+    def __init__(self, comparison, series):
+        self.comparison = comparison
+        self.series = series
+
+        self.ticker = series.ticker
+        self.shown = series.shown
+        self.found = series.found
+
+    def trace(self, deriv, level='daily'):
+        cmp = self.comparison
+        if deriv == 0:
+            i = cmp.start(self.ticker)
+            return [cmp.idx[i:], cmp.columns[self.ticker][0][i:]]
+
+        series = self.series
+        return cmp.relative_derivs(self.ticker, series.smooth, series.kernel)[deriv-1]
+
+    def version(self, deriv):
+        return '%s/%s' % (self.series.version(deriv), self.comparison.benchmark)
+
+    def zeros(self, level='daily'):
+        series = self.series
+        return self.comparison.relative_zeros(self.ticker, series.smooth, series.kernel)
+
+
+# sid -> {benchmark: Comparison}, evicted along the same lines as the
+# series themselves
+sessions = SeriesStore()
+
+def relative(sid, cached, benchmark):
+    '''
+    {ticker: Relative} for every ticker in the session, compared against
+    benchmark (which has to be loaded). Tickers that failed to load are
+    passed through as they are
+    '''
+    comparisons = sessions.get(sid)
+    cmp = comparisons.get(benchmark)
+    if cmp is None or cmp.tables[benchmark] is not cached[benchmark].table:
+        comparisons.clear()
+        comparisons[benchmark] = Comparison(benchmark, cached[benchmark].table)
+
+    cmp = comparisons[benchmark]
+    for ticker in list(cmp.columns):
+        if ticker not in cached:
+            cmp.drop(ticker)
+
+    ret = dict()
+    for ticker, series in cached.items():
+        if series.found:
+            cmp.add(ticker, series.table)
+            ret[ticker] = Relative(cmp, series)
+        else:
+            ret[ticker] = series
+
+    return ret
+
+def compare(tickers, benchmark, window=CORR_WINDOW):
+    '''
+    Latest correlation matrix and relative performance for tickers
+    against benchmark, or None if the benchmark has no data
+    '''
+    tables = q.get_table_many([benchmark] + [t for t in tickers if t != benchmark])
+    benchmark = benchmark.upper()
+    if tables.get(benchmark) is None:
+        return None
+
+    cmp = Comparison(benchmark, tables[benchmark], window)
+    for ticker, table in tables.items():
+        if table is not None:
+            cmp.add(ticker, table)
+
+    names = list(cmp.columns)
+    return {
+        'date': str(cmp.idx[-1].astype('datetime64[D]')),
+        'window': window,
+        'tickers': names,
+        'correlation': [
+            [None if np.isnan(v) else round(float(v), 4) for v in row]
+            for row in cmp.matrix(names)
+        ],
+        'relative': {
+            t: float(cmp.normalized(t)[-1] - cmp.normalized(benchmark, cmp.start(t))[-1])
+            for t in names
+        }
+    }
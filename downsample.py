@@ -0,0 +1,90 @@
+import os
+import numpy as np
+
+# Roughly how many points each trace sent to plotly is allowed. The graph
+# is well under 2000px wide, so anything past that can't be seen anyway
+MAX_POINTS = int(os.environ.get('MAX_POINTS', 2000))
+
+# 'minmax' or 'lttb'
+METHOD = os.environ.get('DOWNSAMPLE', 'minmax')
+
+def minmax(y, n):
+    '''
+    Indices of the min and max of y in each of n//2 equal buckets,
+    so no peak or trough ever disappears
+    '''
+    buckets = max(1, n // 2)
+    size = int(np.ceil(y.shape[0] / buckets))
+
+    # Pad the last bucket with its own last value so everything reshapes
+    pad = size * buckets - y.shape[0]
+    padded = np.concatenate([y, np.full(pad, y[-1])]) if pad else y
+    padded = padded.reshape(buckets, size)
+
+    offsets = np.arange(buckets) * size
+    lo = padded.argmin(axis=1) + offsets
+    hi = padded.argmax(axis=1) + offsets
+
+    idx = np.unique(np.concatenate([lo, hi, [0, y.shape[0]-1]]))
+    return idx[idx < y.shape[0]]
+
+def lttb(x, y, n):
+    '''
+    Largest-Triangle-Three-Buckets: from each bucket keep the point that
+    makes the biggest triangle with the last kept point and the mean of
+    the next bucket
+    '''
+    x = x.astype('datetime64[ns]').astype(np.int64).astype(float) \
+        if np.issubdtype(x.dtype, np.datetime64) else x.astype(float)
+
+    edges = np.linspace(1, y.shape[0]-1, n-1).astype(int)
+    idx = np.empty(n, dtype=int)
+    idx[0], idx[-1] = 0, y.shape[0]-1
+
+    a = 0
+    for i in range(n-2):
+        lo, hi = edges[i], edges[i+1]
+        nxt = slice(hi, edges[i+2] if i+2 < n-1 else y.shape[0])
+        cx, cy = x[nxt].mean(), y[nxt].mean()
+
+        area = np.abs(
+            (x[a] - cx) * (y[lo:hi] - y[a]) -
+            (x[a] - x[lo:hi]) * (cy - y[a])
+        )
+        a = idx[i+1] = lo + area.argmax()
+
+    return idx
+
+def zero_crossings(y, budget):
+    '''
+    Points on either side of every sign change in y. If there are more
+    than budget of them, only the biggest jumps across zero are kept
+    '''
+    gt = y > 0
+    cross = np.flatnonzero(np.logical_xor(gt[1:], gt[:-1])) + 1
+
+    if cross.shape[0] > budget // 2:
+        mags = np.abs(y[cross] - y[cross-1])
+        cross = cross[np.argpartition(mags, -(budget // 2))[-(budget // 2):]]
+
+    return np.concatenate([cross-1, cross])
+
+def downsample(x, y, n=MAX_POINTS, keep_zeros=False):
+    '''
+    Thins out (x, y) to about n points for plotting. With keep_zeros the
+    points around zero-crossings are kept as well, so derivative traces
+    still cross zero exactly where the arrows are
+    '''
+    if n is None or len(y) <= n:
+        return x, y
+
+    x, y = np.asarray(x), np.asarray(y)
+    if METHOD == 'lttb':
+        idx = lttb(x, y, n)
+    else:
+        idx = minmax(y, n)
+
+    if keep_zeros:
+        idx = np.union1d(idx, zero_crossings(y, n // 2))
+
+    return x[idx], y[idx]
@@ -0,0 +1,154 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+from singleflight import file_lock
+from providers import OHLC_DTYPE, get_provider, period_start, to_records, from_records
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Each ticker is an append-only file of OHLC_DTYPE records, oldest first.
+# The last record is the newest bar we have, so only bars after it ever
+# need to come from upstream
+CACHE_DIR = os.environ.get(
+    'HISTORY_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'stock_analyzer', 'history')
+)
+
+# Don't bother asking upstream for new bars more often than this (seconds)
+REFRESH = int(os.environ.get('HISTORY_CACHE_REFRESH', 15*60))
+
+# Relative difference in an overlapping bar that means upstream has
+# re-adjusted its history (split, dividend) and the file must be rebuilt
+ADJUST_TOL = 1e-6
+
+def path(ticker):
+    return os.path.join(CACHE_DIR, ticker.upper() + '.bin')
+
+def lock(f, exclusive):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def read(ticker):
+    '''
+    All stored bars for the ticker, or None if it isn't cached
+    '''
+    try:
+        with open(path(ticker), 'rb') as f:
+            lock(f, False)
+            return np.fromfile(f, dtype=OHLC_DTYPE)
+    except FileNotFoundError:
+        return None
+
+def write(ticker, recs):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    with open(path(ticker), 'ab') as f:
+        lock(f, True)
+        f.truncate(0)
+        recs.tofile(f)
+
+def update(ticker, provider=None):
+    '''
+    Brings the stored history up to date and returns it. Only bars from
+    the second to last stored one onwards are requested: that one is
+    checked against upstream to catch re-adjusted history, and the last
+    one is replaced since it may have been a partial day
+    '''
+    provider = get_provider() if provider is None else provider
+    stored = read(ticker)
+
+    if stored is None or len(stored) < 2:
+        hist = provider.history(ticker, period='max')
+        if hist is None:
+            return None
+
+        recs = to_records(hist)
+        write(ticker, recs)
+        return recs
+
+    overlap = stored[-2]
+    hist = provider.history(ticker, start=pd.Timestamp(overlap['date']))
+    if hist is None:
+        os.utime(path(ticker))
+        return stored
+
+    delta = to_records(hist)
+    delta = delta[delta['date'] >= overlap['date']]
+
+    if not len(delta) or delta[0]['date'] != overlap['date'] \
+            or abs(delta[0]['close'] - overlap['close']) > ADJUST_TOL * abs(overlap['close']):
+        # History was re-adjusted upstream, start over
+        hist = provider.history(ticker, period='max')
+        if hist is None:
+            return stored
+
+        recs = to_records(hist)
+        write(ticker, recs)
+        return recs
+
+    with open(path(ticker), 'r+b') as f:
+        lock(f, True)
+        f.truncate((len(stored)-1) * OHLC_DTYPE.itemsize)
+        f.seek(0, os.SEEK_END)
+        delta[1:].tofile(f)
+
+    return np.concatenate([stored[:-1], delta[1:]])
+
+def prefetch(tickers, provider=None):
+    '''
+    Downloads every ticker that isn't cached at all in one multi-symbol
+    request. Tickers that are already cached only need their (small)
+    deltas, which history() takes care of
+    '''
+    provider = get_provider() if provider is None else provider
+    cold = [t for t in tickers if not os.path.exists(path(t))]
+    if not cold:
+        return
+
+    for t, hist in provider.history_many(cold, period='max').items():
+        if hist is not None:
+            with file_lock(('history', t.upper())):
+                write(t, to_records(hist))
+
+def updated(ticker):
+    '''
+    When the ticker was last brought up to date, None if it isn't cached
+    '''
+    try:
+        return os.path.getmtime(path(ticker))
+    except FileNotFoundError:
+        return None
+
+def is_fresh(ticker):
+    stamp = updated(ticker)
+    return stamp is not None and time.time() - stamp < REFRESH
+
+def history(ticker, period='max', provider=None):
+    '''
+    Same contract as Provider.history, but served from the local cache
+    whenever it was refreshed in the last REFRESH seconds
+    '''
+    if is_fresh(ticker):
+        recs = read(ticker)
+    else:
+        # Another worker may have refreshed it while we waited
+        with file_lock(('history', ticker.upper())):
+            recs = read(ticker) if is_fresh(ticker) else update(ticker, provider)
+
+    if recs is None:
+        return None
+
+    start = period_start(period)
+    if start is not None:
+        recs = recs[np.searchsorted(recs['date'], np.datetime64(start, 'ns')):]
+
+    if not len(recs):
+        return None
+
+    return from_records(recs)
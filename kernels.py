@@ -0,0 +1,125 @@
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# Bars each kernel smooths over
+WINDOW = int(os.environ.get('KERNEL_WINDOW', 10))
+
+# Degree of the polynomial Savitzky-Golay fits to each window
+SAVGOL_ORDER = int(os.environ.get('SAVGOL_ORDER', 2))
+
+# Every kernel only looks at the current bar and the ones before it, so
+# the batch and incremental versions agree and a smoothed series never
+# changes once it's been drawn. Until there's a full window the FIR
+# kernels pass prices through as they are
+
+def sma(x, window=WINDOW):
+    cs = np.cumsum(x, dtype=float)
+    out = cs.copy()
+    out[window:] = cs[window:] - cs[:-window]
+    return out / np.minimum(np.arange(1, cs.shape[0]+1), window)
+
+def ema(x, window=WINDOW):
+    return pd.Series(x, dtype=float).ewm(span=window, adjust=False).mean().values
+
+def savgol_weights(window=WINDOW, order=SAVGOL_ORDER):
+    '''
+    Weights of the newest bar first. Fitting a polynomial to the window
+    and reading it off at the newest bar is a fixed linear combination
+    of the window
+    '''
+    t = -np.arange(window, dtype=float)
+    return np.linalg.pinv(t[:, None] ** np.arange(order+1))[0]
+
+def gaussian_weights(window=WINDOW):
+    '''
+    Right half of a gaussian, newest bar first
+    '''
+    w = np.exp(-0.5 * (np.arange(window) / (window / 3)) ** 2)
+    return w / w.sum()
+
+def fir(x, weights):
+    out = np.array(x, dtype=float)
+    n = weights.shape[0]
+    if out.shape[0] >= n:
+        out[n-1:] = np.convolve(out, weights, mode='valid')
+
+    return out
+
+def savgol(x, window=WINDOW):
+    return fir(x, savgol_weights(window))
+
+def gaussian(x, window=WINDOW):
+    return fir(x, gaussian_weights(window))
+
+
+class Identity:
+    def update(self, x):
+        return x
+
+
+class SMA:
+    '''
+    Incremental versions: update() takes the next bar and returns its
+    smoothed value, in constant time
+    '''
+    def __init__(self, window=WINDOW):
+        self.buf = deque(maxlen=window)
+        self.total = 0.0
+
+    def update(self, x):
+        if len(self.buf) == self.buf.maxlen:
+            self.total -= self.buf[0]
+
+        self.buf.append(x)
+        self.total += x
+        return self.total / len(self.buf)
+
+
+class EMA:
+    def __init__(self, window=WINDOW):
+        self.alpha = 2 / (window + 1)
+        self.value = None
+
+    def update(self, x):
+        if self.value is None:
+            self.value = float(x)
+        else:
+            self.value += self.alpha * (x - self.value)
+
+        return self.value
+
+
+class FIR:
+    def __init__(self, weights):
+        self.weights = weights
+        self.buf = deque(maxlen=weights.shape[0])
+
+    def update(self, x):
+        self.buf.appendleft(x)
+        if len(self.buf) < self.buf.maxlen:
+            return x
+
+        return float(np.dot(self.weights, self.buf))
+
+
+# name -> (label, batch, incremental)
+KERNELS = {
+    'none': ('None', None, lambda window: Identity()),
+    'sma': ('SMA', sma, SMA),
+    'ema': ('EMA', ema, EMA),
+    'savgol': ('Savitzky-Golay', savgol, lambda window: FIR(savgol_weights(window))),
+    'gaussian': ('Gaussian', gaussian, lambda window: FIR(gaussian_weights(window))),
+}
+
+def apply(x, kernel='none', window=WINDOW):
+    '''
+    x smoothed with the named kernel, same length as x
+    '''
+    batch = KERNELS[kernel][1]
+    return x if batch is None else batch(x, window)
+
+def incremental(kernel='none', window=WINDOW):
+    return KERNELS[kernel][2](window)
@@ -0,0 +1,367 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+import batcher
+import kernels
+import queries as q
+from providers import get_provider, to_records, YFinanceProvider
+
+# Bars kept per ticker while live, older ones are overwritten
+LIVE_BARS = int(os.environ.get('LIVE_BARS', 5000))
+
+# How often the browser asks for new bars, in ms. A ticker's feed is
+# never polled more often than this no matter how many sessions watch it
+LIVE_INTERVAL = int(os.environ.get('LIVE_INTERVAL', 5000))
+
+# Bars per rolling-avg unit. On daily charts a unit is a week (5 bars),
+# live it's the same number of whatever bars the feed sends
+LIVE_PER_WEEK = float(os.environ.get('LIVE_PER_WEEK', 5))
+
+# Tickers each worker streams at once, least recently watched go first
+LIVE_TICKERS = int(os.environ.get('LIVE_TICKERS', 64))
+
+
+class Feed:
+    '''
+    Anything that can hand back the latest bars for a ticker. bars()
+    returns an OHLC_DTYPE array of the bars dated after `after` (recent
+    history when it's None), or None if the ticker is unknown
+    '''
+    def bars(self, ticker, after=None):
+        raise NotImplementedError
+
+
+class YFinanceFeed(Feed):
+    '''
+    Polls go through a batcher like daily history does, so every ticker
+    polled at about the same time (by any session) is one download, and
+    they share the same rate limit
+    '''
+    def __init__(self, interval='1m'):
+        self.interval = interval
+        self.upstream = batcher.BatchingProvider(YFinanceProvider(interval), source='live')
+
+    def bars(self, ticker, after=None):
+        hist = self.upstream.history(ticker, period='5d' if after is None else '1d')
+        if hist is None or not len(hist):
+            return None
+
+        recs = to_records(hist)
+        if after is not None:
+            recs = recs[recs['date'] > after]
+
+        return recs
+
+
+class ReplayFeed(Feed):
+    '''
+    Plays a provider's history back as if it were live: the first warmup
+    bars straight away, then per_poll more every time it's polled. With
+    LocalProvider or SyntheticProvider nothing touches the network
+    '''
+    def __init__(self, provider=None, warmup=1000, per_poll=1):
+        self.provider = provider
+        self.warmup = warmup
+        self.per_poll = per_poll
+
+        self.history = dict()
+        self.pos = dict()
+        self.lock = threading.Lock()
+
+    def bars(self, ticker, after=None):
+        ticker = ticker.upper()
+
+        with self.lock:
+            if ticker not in self.history:
+                df = (self.provider or get_provider()).history(ticker)
+                self.history[ticker] = None if df is None else to_records(df)
+
+            recs = self.history[ticker]
+            if recs is None:
+                return None
+
+            pos = self.pos.get(ticker)
+            end = self.warmup if pos is None else pos + self.per_poll
+            self.pos[ticker] = end = min(end, recs.shape[0])
+
+        start = 0 if after is None else np.searchsorted(recs['date'], after, 'right')
+        return recs[start:end]
+
+
+class Ring:
+    '''
+    Fixed size array that overwrites its oldest values. Positions are
+    absolute (the nth value ever appended is ring[n]) and valid for as
+    long as that value is still in the buffer
+    '''
+    def __init__(self, size, dtype):
+        self.size = size
+        self.data = np.zeros(size, dtype=dtype)
+        self.n = 0
+
+    @property
+    def first(self):
+        return max(0, self.n - self.size)
+
+    def append(self, value):
+        self.data[self.n % self.size] = value
+        self.n += 1
+
+    def __getitem__(self, i):
+        return self.data[i % self.size]
+
+    def since(self, i):
+        '''
+        Everything from position i on, oldest first. A view unless it
+        wraps around the end of the buffer
+        '''
+        i = max(i, self.first)
+        if i >= self.n:
+            return self.data[:0]
+
+        a, b = i % self.size, self.n % self.size
+        if a < b:
+            return self.data[a:b]
+
+        return np.concatenate([self.data[a:], self.data[:b]])
+
+    def search(self, value):
+        '''
+        First position holding something > value, for sorted contents
+        '''
+        lo, hi = self.first, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+
+class LiveDeriv:
+    '''
+    queries.derivatives for one smooth and kernel, plus the zero-crossings
+    of the second derivative ZeroIndex would find, kept up to date a bar
+    at a time.
+    Each bar only looks offset bars back (and the kernel a window back),
+    so a tick costs the same however long the stream has been running
+    '''
+    def __init__(self, stream, smooth, kernel='none'):
+        self.offset = max(1, int(smooth*LIVE_PER_WEEK))
+        # Ring k-1 is order k
+        self.orders = [Ring(stream.size, np.float64) for _ in range(q.MAX_ORDER)]
+
+        # Smoothed prices, what the derivatives are taken of
+        self.kclose, self.kopen = kernels.incremental(kernel), kernels.incremental(kernel)
+        self.close = Ring(stream.size, np.float64)
+        self.open = Ring(stream.size, np.float64)
+
+        # (position, date before, date, magnitude), oldest first
+        self.zeros = deque()
+
+        # Positions line up with the stream's, even when it's been
+        # running for a while before this smooth was asked for
+        for ring in self.orders + [self.close, self.open]:
+            ring.n = stream.dates.first
+        for i in range(stream.dates.first, stream.dates.n):
+            self.push(stream, i)
+
+    def push(self, stream, i):
+        off = self.offset
+        first = stream.dates.first
+
+        self.close.append(self.kclose.update(stream.close[i]))
+        self.open.append(self.kopen.update(stream.open[i]))
+
+        # The first derivative as queries.differences has it
+        d = self.orders[0]
+        if i - off >= first:
+            close = self.close[i-off]
+            d.append((self.open[i] - close) / close)
+        else:
+            d.append(np.nan)
+
+        # Each order is the one below it minus itself offset bars back
+        for k in range(1, len(self.orders)):
+            below = self.orders[k-1]
+            if i - (k+1)*off >= first:
+                self.orders[k].append(below[i] - below[i-off])
+            else:
+                self.orders[k].append(np.nan)
+
+        dd = self.orders[1]
+        if i - 1 >= first:
+            prev, cur = dd[i-1], dd[i]
+            if np.isfinite(prev) and np.isfinite(cur) and (prev > 0) != (cur > 0):
+                self.zeros.append((i, stream.dates[i-1], stream.dates[i], cur - prev))
+
+        # Only crossings on the part of dd that trace() still returns
+        while self.zeros and self.zeros[0][0] - 1 < first + 2*off:
+            self.zeros.popleft()
+
+
+class Stream:
+    '''
+    The last LIVE_BARS bars of one ticker, and the derivatives for every
+    smooth and kernel someone is looking at
+    '''
+    def __init__(self, ticker, feed, size=LIVE_BARS):
+        self.ticker = ticker
+        self.feed = feed
+        self.size = size
+
+        self.dates = Ring(size, 'datetime64[ns]')
+        self.close = Ring(size, np.float64)
+        self.open = Ring(size, np.float64)
+
+        self.derivs = OrderedDict()
+        self.found = True
+        self.polled = 0
+        self.lock = threading.Lock()
+
+    def poll(self):
+        '''
+        Appends whatever the feed has that's newer than the last bar.
+        Returns how many bars came in
+        '''
+        with self.lock:
+            if time.time() - self.polled < LIVE_INTERVAL / 1000:
+                return 0
+            self.polled = time.time()
+
+            recs = self.feed.bars(self.ticker, after=self.last)
+            if recs is None:
+                self.found = self.dates.n > 0
+                return 0
+
+            for rec in recs:
+                self.append(rec)
+
+            return len(recs)
+
+    def append(self, rec):
+        i = self.dates.n
+        self.dates.append(rec['date'])
+        self.close.append(rec['close'])
+        self.open.append(rec['open'])
+
+        for deriv in self.derivs.values():
+            deriv.push(self, i)
+
+    def deriv(self, smooth, kernel='none'):
+        # Only the last few smoothing values anyone asked for are kept up
+        # to date, the rest are rebuilt from the buffer if they come back
+        key = (smooth, kernel)
+        if key not in self.derivs:
+            if len(self.derivs) >= 8:
+                self.derivs.popitem(last=False)
+            self.derivs[key] = LiveDeriv(self, smooth, kernel)
+
+        self.derivs.move_to_end(key)
+        return self.derivs[key]
+
+    def trace(self, deriv, smooth, after=None, kernel='none'):
+        '''
+        (dates, values) of the price (0) or a derivative (1..MAX_ORDER)
+        for every bar newer than after, and whether that's the whole
+        buffer (the caller had nothing, or fell too far behind)
+        '''
+        with self.lock:
+            start = self.dates.first
+            i = start if after is None else self.dates.search(after)
+            reset = i <= start
+
+            if deriv == 0:
+                # The open, same as the price lookup draws
+                return self.dates.since(i), self.open.since(i), reset
+
+            d = self.deriv(smooth, kernel)
+            ring = d.orders[deriv-1]
+            i = max(i, start + deriv*d.offset)
+            return self.dates.since(i), ring.since(i), reset
+
+    def zeros(self, smooth, kernel='none'):
+        '''
+        Every zero-crossing of the second derivative still in the buffer,
+        as the (prev, dates, mags) arrays ZeroIndex would have
+        '''
+        with self.lock:
+            zeros = self.deriv(smooth, kernel).zeros
+            prev = np.array([z[1] for z in zeros], dtype='datetime64[ns]')
+            dates = np.array([z[2] for z in zeros], dtype='datetime64[ns]')
+            mags = np.array([z[3] for z in zeros], dtype=np.float64)
+
+        return prev, dates, mags
+
+    def zeros_version(self, smooth, kernel='none'):
+        '''
+        Changes whenever a crossing comes in or falls off the buffer
+        '''
+        with self.lock:
+            zeros = self.deriv(smooth, kernel).zeros
+            return '%d:%d' % (zeros[0][0], zeros[-1][0]) if zeros else ''
+
+    @property
+    def last(self):
+        return self.dates[self.dates.n-1] if self.dates.n else None
+
+
+class Streams:
+    '''
+    Stream per ticker, shared by every session in the worker
+    '''
+    def __init__(self, max_streams=LIVE_TICKERS):
+        self.max_streams = max_streams
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ticker):
+        ticker = ticker.upper()
+        with self.lock:
+            if ticker not in self.streams:
+                self.streams[ticker] = Stream(ticker, get_feed())
+                while len(self.streams) > self.max_streams:
+                    self.streams.popitem(last=False)
+
+            self.streams.move_to_end(ticker)
+            return self.streams[ticker]
+
+    def clear(self):
+        with self.lock:
+            self.streams.clear()
+
+    def __len__(self):
+        return len(self.streams)
+
+
+def from_env():
+    '''
+    LIVE_FEED=replay plays back history from the market data provider,
+    anything else streams 1 minute bars from yfinance
+    '''
+    if os.environ.get('LIVE_FEED', 'yfinance') == 'replay':
+        return ReplayFeed()
+
+    return YFinanceFeed()
+
+_feed = None
+
+def get_feed():
+    global _feed
+    if _feed is None:
+        _feed = from_env()
+
+    return _feed
+
+def set_feed(feed):
+    global _feed
+    _feed = feed
+    streams.clear()
+
+
+streams = Streams()
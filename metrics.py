@@ -0,0 +1,175 @@
+import os
+import time
+import json
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+import flask
+
+# Callbacks slower than this get logged, 0 turns the log off
+SLOW_CALLBACK_MS = float(os.environ.get('SLOW_CALLBACK_MS', 0))
+
+TIME_BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [2**i for i in range(8, 26, 2)]
+
+log = logging.getLogger('stock_analyzer.metrics')
+
+class Histogram:
+    '''
+    Prometheus style histogram, one set of buckets per label combination.
+    Every worker keeps its own
+    '''
+    def __init__(self, name, doc, buckets):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            counts, _, _ = s = self.series[key]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+
+            s[1] += 1
+            s[2] += value
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.doc),
+            '# TYPE %s histogram' % self.name
+        ]
+
+        with self.lock:
+            for key, (counts, n, total) in sorted(self.series.items()):
+                labels = ','.join('%s="%s"' % kv for kv in key)
+                sep = ',' if labels else ''
+
+                for b, c in zip(self.buckets, counts):
+                    lines.append('%s_bucket{%s%sle="%g"} %d' % (self.name, labels, sep, b, c))
+                lines.append('%s_bucket{%s%sle="+Inf"} %d' % (self.name, labels, sep, n))
+                lines.append('%s_count{%s} %d' % (self.name, labels, n))
+                lines.append('%s_sum{%s} %g' % (self.name, labels, total))
+
+        return '\n'.join(lines)
+
+
+callback_seconds = Histogram(
+    'callback_seconds', 'Time spent inside Dash callback functions', TIME_BUCKETS)
+request_seconds = Histogram(
+    'callback_request_seconds', 'Wall time of Dash callback requests', TIME_BUCKETS)
+serialize_seconds = Histogram(
+    'callback_serialize_seconds', 'Request time not spent in the callback (JSON decode/encode, dispatch)', TIME_BUCKETS)
+request_bytes = Histogram(
+    'callback_request_bytes', 'Size of Dash callback request bodies', SIZE_BUCKETS)
+response_bytes = Histogram(
+    'callback_response_bytes', 'Size of Dash callback response bodies', SIZE_BUCKETS)
+fetch_seconds = Histogram(
+    'fetch_seconds', 'Time spent in market data provider requests, cache reads excluded', TIME_BUCKETS)
+compute_seconds = Histogram(
+    'compute_seconds', 'Time spent computing derivatives and indexes', TIME_BUCKETS)
+fetch_batch_size = Histogram(
+    'fetch_batch_size', 'Tickers in each upstream download', [1, 2, 4, 8, 16, 32, 64, 128])
+
+histograms = [
+    callback_seconds, request_seconds, serialize_seconds,
+    request_bytes, response_bytes, fetch_seconds, compute_seconds,
+    fetch_batch_size
+]
+
+# name -> fn returning {metric: value}, rendered as gauges
+gauges = dict()
+
+@contextmanager
+def timer(histogram, **labels):
+    '''
+    Records how long the block takes in histogram. For Dash callbacks the
+    time is also remembered for the request's other metrics
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.observe(elapsed, **labels)
+
+        if histogram is callback_seconds and flask.has_request_context():
+            flask.g.callback_seconds = elapsed
+
+def timed(histogram, **labels):
+    '''
+    Decorator version of timer
+    '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(histogram, **labels):
+                return fn(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+def render():
+    out = [h.render() for h in histograms]
+
+    for name, fn in gauges.items():
+        for metric, value in fn().items():
+            out.append('# TYPE %s_%s gauge\n%s_%s %g' % (name, metric, name, metric, value))
+
+    return '\n'.join(out) + '\n'
+
+def install(app):
+    '''
+    Times every callback request on the app's server and serves
+    everything collected at /metrics
+    '''
+    server = app.server
+
+    def callback_name():
+        try:
+            output = json.loads(flask.request.get_data())['output']
+            return app.callback_map[output]['callback'].__name__
+        except Exception:
+            return 'unknown'
+
+    @server.before_request
+    def start_timer():
+        if flask.request.path.endswith('_dash-update-component'):
+            flask.g.request_start = time.perf_counter()
+
+    @server.after_request
+    def record(response):
+        if 'request_start' not in flask.g:
+            return response
+
+        wall = time.perf_counter() - flask.g.request_start
+        name = callback_name()
+        size_in = flask.request.content_length or 0
+        size_out = response.calculate_content_length() or 0
+
+        request_seconds.observe(wall, callback=name)
+        serialize_seconds.observe(wall - flask.g.get('callback_seconds', 0), callback=name)
+        request_bytes.observe(size_in, callback=name)
+        response_bytes.observe(size_out, callback=name)
+
+        if SLOW_CALLBACK_MS and wall*1000 > SLOW_CALLBACK_MS:
+            log.warning(
+                'Slow callback %s: %.1fms (%d bytes in, %d bytes out)',
+                name, wall*1000, size_in, size_out
+            )
+
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,216 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import history_cache
+import queries as q
+from result_cache import results
+from singleflight import file_lock
+from providers import LocalProvider
+
+# Set PREFETCH=0 to only ever compute tables when someone asks for them
+ENABLED = os.environ.get('PREFETCH', '1') != '0'
+
+# How many of the most viewed tickers are kept warm, and how often
+# (seconds) the scheduler checks on them
+TOP = int(os.environ.get('PREFETCH_TOP', 20))
+INTERVAL = int(os.environ.get('PREFETCH_INTERVAL', 60))
+
+# Warm from the start, before anyone has asked for anything
+SEED = [t for t in os.environ.get('PREFETCH_SEED', 'SPY,QQQ').upper().split(',') if t]
+
+# Zero indexes are prebuilt for this many of the most used smooths
+SMOOTHS = int(os.environ.get('PREFETCH_SMOOTHS', 3))
+
+# Views older than this count half as much (seconds)
+HALF_LIFE = int(os.environ.get('PREFETCH_HALF_LIFE', 6*60*60))
+
+# Hot tickers are refreshed once the day's last bar is in
+MARKET_TZ = os.environ.get('MARKET_TZ', 'America/New_York')
+MARKET_CLOSE = os.environ.get('MARKET_CLOSE', '16:15')
+
+log = logging.getLogger('stock_analyzer.prefetch')
+
+# Separate from queries.pool so warming never queues ahead of a user
+pool = ThreadPoolExecutor(int(os.environ.get('PREFETCH_WORKERS', 4)))
+
+
+class Tracker:
+    '''
+    Decaying view counts per (ticker, kernel) and per smooth, for this
+    worker. Every worker sees about the same mix of traffic, so they
+    agree on what's popular closely enough
+    '''
+    def __init__(self, half_life=HALF_LIFE):
+        self.half_life = half_life
+        self.views = dict()
+        self.smooths = dict()
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def hit(self, tickers, smooth, kernel='none'):
+        with self.lock:
+            for t in tickers:
+                key = (t.upper(), kernel)
+                self.views[key] = self.views.get(key, 0) + 1
+
+            self.smooths[smooth] = self.smooths.get(smooth, 0) + 1
+
+    def decay(self, now=None):
+        '''
+        Scales every count down for the time since the last decay, and
+        forgets whatever's dropped to (almost) nothing
+        '''
+        now = time.time() if now is None else now
+        factor = 0.5 ** ((now - self.stamp) / self.half_life)
+        self.stamp = now
+
+        with self.lock:
+            for counts in (self.views, self.smooths):
+                for key in list(counts):
+                    counts[key] *= factor
+                    if counts[key] < 0.05:
+                        del counts[key]
+
+    def top(self, n):
+        with self.lock:
+            return sorted(self.views, key=self.views.get, reverse=True)[:n]
+
+    def top_smooths(self, n):
+        with self.lock:
+            return sorted(self.smooths, key=self.smooths.get, reverse=True)[:n]
+
+
+class Scheduler:
+    '''
+    Keeps the tables of the TOP most viewed tickers (plus SEED) in the
+    result cache, so their first view is a cache read. Every INTERVAL
+    seconds it recomputes the ones about to expire, refreshes all of them
+    once after the close, and drops the ones that stopped being hot
+    '''
+    def __init__(self, tracker, top=TOP, interval=INTERVAL, seed=SEED):
+        self.tracker = tracker
+        self.top = top
+        self.interval = interval
+        self.seed = seed
+
+        self.warm = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                log.exception('Prefetch failed')
+
+            time.sleep(self.interval)
+
+    def hot(self):
+        hot = [(t, 'none') for t in self.seed]
+        for key in self.tracker.top(self.top):
+            if key not in hot:
+                hot.append(key)
+
+        return hot[:max(self.top, len(self.seed))]
+
+    def tick(self, now=None):
+        '''
+        One round of warming and eviction. Tickers are warmed
+        concurrently so their downloads can share a batch
+        '''
+        hot = self.hot()
+        close = last_close(now)
+        smooths = self.tracker.top_smooths(SMOOTHS) or [4]
+
+        list(pool.map(lambda key: self.warm_one(*key, smooths, close), hot))
+
+        # Nobody's looking at these any more, make room for the ones
+        # people are
+        for ticker, kernel in self.warm - set(hot):
+            results.delete(q.table_key(ticker, kernel=kernel))
+
+        self.warm = set(hot)
+        self.tracker.decay()
+
+    def warm_one(self, ticker, kernel, smooths, close):
+        key = q.table_key(ticker, kernel=kernel)
+        created = results.created(key)
+
+        expiring = created is None or time.time() - created > results.ttl - 2*self.interval
+        stale = close is not None and (created or 0) < close
+        if not (expiring or stale):
+            return
+
+        with file_lock(('result', key)):
+            # Another worker may have just done it
+            created = results.created(key)
+            if created is not None and created > time.time() - self.interval \
+                    and (close is None or created >= close):
+                return
+
+            if stale:
+                refresh_history(ticker, close)
+
+            table = q.compute_table(ticker, kernel=kernel)
+            if table is None:
+                return
+
+            # Stored with the table, so sessions get them for free
+            for s in smooths:
+                for level in q.LEVELS:
+                    q.zero_index(table, s, level)
+
+            q.tables.put(key, table)
+
+def refresh_history(ticker, since):
+    '''
+    Brings the cached history up to date if it hasn't been since the
+    close, however recently it was last checked before that
+    '''
+    provider = q.upstream()
+    if not q.USE_HISTORY_CACHE or isinstance(provider, LocalProvider):
+        return
+
+    with file_lock(('history', ticker.upper())):
+        if (history_cache.updated(ticker) or 0) < since:
+            history_cache.update(ticker, provider)
+
+def last_close(now=None):
+    '''
+    Today's close as a unix timestamp once it's passed on a weekday,
+    None otherwise
+    '''
+    now = pd.Timestamp.now(tz=MARKET_TZ) if now is None else now
+    close = pd.Timestamp(now.strftime('%Y-%m-%d ') + MARKET_CLOSE, tz=MARKET_TZ)
+
+    if now.weekday() >= 5 or now < close:
+        return None
+
+    return close.timestamp()
+
+
+tracker = Tracker()
+scheduler = Scheduler(tracker)
+
+def start():
+    '''
+    Starts the scheduler if it isn't running yet. Cheap enough to call
+    on every request
+    '''
+    if ENABLED:
+        scheduler.start()
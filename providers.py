@@ -0,0 +1,258 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+# One record per bar. Every on-disk format uses this layout so files can
+# be memory mapped and sliced without parsing anything
+OHLC_DTYPE = np.dtype([
+    ('date', '<M8[ns]'),
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8')
+])
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# yfinance period strings -> days of history
+PERIODS = {
+    '1d': 1, '5d': 5,
+    '1mo': 30, '3mo': 30*3, '6mo': 30*6,
+    '1y': 365, '2y': 365*2, '5y': 365*5, '10y': 365*10
+}
+
+def period_start(period, end=None):
+    '''
+    First date covered by a yfinance style period string, or None
+    for 'max'
+    '''
+    if period is None or period == 'max':
+        return None
+
+    end = pd.Timestamp.now() if end is None else pd.Timestamp(end)
+    if period == 'ytd':
+        return pd.Timestamp(year=end.year, month=1, day=1)
+
+    return end.normalize() - pd.Timedelta(days=PERIODS[period])
+
+def to_records(df):
+    '''
+    DataFrame as returned by yfinance -> OHLC_DTYPE array
+    '''
+    idx = df.index
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+
+    recs = np.empty(len(df), dtype=OHLC_DTYPE)
+    recs['date'] = idx.values
+    for col in COLUMNS:
+        recs[col.lower()] = df[col].values
+
+    return recs
+
+def from_records(recs):
+    return pd.DataFrame(
+        {col: recs[col.lower()] for col in COLUMNS},
+        index=pd.DatetimeIndex(recs['date'], name='Date')
+    )
+
+
+class Provider:
+    '''
+    Anything that can hand back daily bars for a ticker. history() returns
+    a DataFrame with (at least) the columns in COLUMNS indexed by date, or
+    None if the ticker is unknown. Bars are limited to those on or after
+    start when it's given, otherwise to the period.
+    '''
+    def history(self, ticker, period='max', start=None):
+        raise NotImplementedError
+
+    def history_many(self, tickers, period='max', start=None):
+        '''
+        {ticker: history(ticker, period, start)}. Providers that can
+        download several symbols in one request should override this
+        '''
+        return {t: self.history(t, period=period, start=start) for t in tickers}
+
+
+class YFinanceProvider(Provider):
+    def __init__(self, interval='1d'):
+        self.interval = interval
+
+    def history(self, ticker, period='max', start=None):
+        stock = yf.Ticker(ticker)
+
+        if start is not None:
+            hist = stock.history(start=start, interval=self.interval)
+        else:
+            hist = stock.history(period=period, interval=self.interval)
+
+        if not len(hist):
+            return None
+
+        return hist
+
+    def history_many(self, tickers, period='max', start=None):
+        if len(tickers) < 2:
+            return super().history_many(tickers, period=period, start=start)
+
+        # Same adjustment as Ticker.history so the two can be mixed
+        when = {'period': period} if start is None else {'start': start}
+        hist = yf.download(
+            tickers, group_by='ticker', auto_adjust=True, interval=self.interval,
+            threads=True, progress=False, **when
+        )
+
+        ret = dict()
+        for t in tickers:
+            df = hist[t].dropna(how='all') if t in hist.columns.levels[0] else []
+            ret[t] = df if len(df) else None
+
+        return ret
+
+
+class LocalProvider(Provider):
+    '''
+    Serves bars from a pre-populated directory. Each ticker is either
+    TICKER.npy (an OHLC_DTYPE array, memory mapped) or TICKER.parquet
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, ticker, ext):
+        return os.path.join(self.root, ticker.upper() + ext)
+
+    def history(self, ticker, period='max', start=None):
+        if start is None:
+            start = period_start(period)
+
+        npy = self.path(ticker, '.npy')
+        if os.path.exists(npy):
+            recs = np.load(npy, mmap_mode='r')
+            if start is not None:
+                recs = recs[np.searchsorted(recs['date'], np.datetime64(start, 'ns')):]
+
+            df = from_records(recs)
+
+        elif os.path.exists(self.path(ticker, '.parquet')):
+            df = pd.read_parquet(self.path(ticker, '.parquet'))
+            if start is not None:
+                df = df[df.index >= pd.Timestamp(start)]
+
+        else:
+            return None
+
+        if not len(df):
+            return None
+
+        return df
+
+    def tickers(self):
+        '''
+        Every ticker in the dataset
+        '''
+        if not os.path.isdir(self.root):
+            return []
+
+        return sorted(set(
+            name.rsplit('.', 1)[0] for name in os.listdir(self.root)
+            if name.endswith('.npy') or name.endswith('.parquet')
+        ))
+
+    def tail(self, ticker, n):
+        '''
+        The last n bars as OHLC_DTYPE records, without going through a
+        DataFrame. None if the ticker isn't in the dataset
+        '''
+        npy = self.path(ticker, '.npy')
+        if os.path.exists(npy):
+            recs = np.load(npy, mmap_mode='r')[-n:]
+        else:
+            df = self.history(ticker)
+            recs = None if df is None else to_records(df)[-n:]
+
+        return recs if recs is not None and len(recs) else None
+
+    def write(self, ticker, df, fmt='npy'):
+        os.makedirs(self.root, exist_ok=True)
+
+        if fmt == 'parquet':
+            df[COLUMNS].to_parquet(self.path(ticker, '.parquet'))
+        else:
+            np.save(self.path(ticker, '.npy'), to_records(df))
+
+
+class SyntheticProvider(Provider):
+    '''
+    Random walk prices for any ticker, the same ones every time for the
+    same ticker. For benchmarks and load tests that shouldn't touch the
+    network or need a dataset on disk
+    '''
+    def __init__(self, bars=10000):
+        self.bars = bars
+
+    def history(self, ticker, period='max', start=None):
+        seed = int.from_bytes(ticker.upper().encode(), 'little') % 2**32
+        rng = np.random.default_rng(seed)
+
+        idx = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=self.bars)
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, self.bars)))
+        open = close * (1 + rng.normal(0, 0.002, self.bars))
+
+        df = pd.DataFrame({
+            'Open': open,
+            'High': np.maximum(open, close),
+            'Low': np.minimum(open, close),
+            'Close': close,
+            'Volume': rng.integers(1e5, 1e7, self.bars).astype(float)
+        }, index=idx)
+
+        start = period_start(period) if start is None else start
+        if start is not None:
+            df = df[df.index >= pd.Timestamp(start)]
+
+        return df
+
+
+def from_env():
+    '''
+    MARKET_DATA=local serves everything from MARKET_DATA_DIR and
+    MARKET_DATA=synthetic makes prices up, anything else goes to yfinance
+    '''
+    source = os.environ.get('MARKET_DATA', 'yfinance')
+    if source == 'local':
+        return LocalProvider(os.environ.get('MARKET_DATA_DIR', 'market_data'))
+    if source == 'synthetic':
+        return SyntheticProvider()
+
+    return YFinanceProvider()
+
+_provider = None
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        _provider = from_env()
+
+    return _provider
+
+def set_provider(provider):
+    global _provider
+    _provider = provider
+
+
+if __name__ == '__main__':
+    # Populate the local dataset: python providers.py SPY QQQ ...
+    local = LocalProvider(os.environ.get('MARKET_DATA_DIR', 'market_data'))
+    remote = YFinanceProvider()
+
+    for ticker in sys.argv[1:]:
+        hist = remote.history(ticker.upper())
+        if hist is None:
+            print('No data for', ticker)
+            continue
+
+        local.write(ticker.upper(), hist)
+        print(ticker.upper(), len(hist), 'bars')
@@ -1,12 +1,74 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import pandas as pd
-import yfinance as yf 
+
+import batcher
+import history_cache
+import kernels
+import metrics
+from result_cache import results, LocalCache
+from singleflight import flights
+from providers import get_provider, LocalProvider
+
+# Serve repeat lookups from the on-disk history cache unless the data
+# is already coming off local disk
+USE_HISTORY_CACHE = os.environ.get('HISTORY_CACHE', '1') != '0'
+
+# Derivatives for every rolling-avg value up to this many weeks are
+# computed as soon as a ticker is loaded
+MAX_SMOOTH = int(os.environ.get('MAX_SMOOTH', 52))
+
+# Highest derivative the checklist goes up to. Every order is one more
+# difference of the one below it, so the tables only keep the first and
+# lookup works out the rest
+MAX_ORDER = int(os.environ.get('MAX_ORDER', 4))
+
+# Resolutions kept for every ticker, finest first, and how many of
+# their bars make up a week. rolling-avg is in weeks, so this turns it
+# into a bar offset at each level
+LEVELS = {'daily': 5, 'weekly': 1, 'monthly': 12/52}
+
+# Tables kept as objects in each worker and shared by every session
+# showing the ticker. One is a few MB, see deriv_table
+TABLE_CACHE_SIZE = int(os.environ.get('TABLE_CACHE_SIZE', 32))
+tables = LocalCache(results, TABLE_CACHE_SIZE)
+
+# Bounds how many tickers get_all_many works on at once
+pool = ThreadPoolExecutor(int(os.environ.get('FETCH_WORKERS', 8)))
 
 def get_hist(ticker, period):
-    stock = yf.Ticker(ticker)
+    # Concurrent requests for the same ticker share one fetch
+    return flights.do(
+        ('hist', ticker.upper(), period),
+        lambda: fetch_hist(ticker, period)
+    )
 
-    hist = stock.history(period=period)
-    if not len(hist):
+def upstream():
+    '''
+    The market data provider. Anything but local files goes through the
+    batcher, so tickers different sessions ask for at about the same time
+    share one download
+    '''
+    provider = get_provider()
+    if isinstance(provider, LocalProvider):
+        return provider
+
+    return batcher.batched(provider)
+
+def fetch_hist(ticker, period):
+    provider = upstream()
+
+    # Only time actually spent in providers goes in fetch_seconds, the
+    # batcher times its own downloads
+    if isinstance(provider, LocalProvider):
+        with metrics.timer(metrics.fetch_seconds, source='local'):
+            hist = provider.history(ticker, period=period)
+    elif USE_HISTORY_CACHE:
+        hist = history_cache.history(ticker, period=period, provider=provider)
+    else:
+        hist = provider.history(ticker, period=period)
+
+    if hist is None or not len(hist):
         return None 
 
     return hist
@@ -17,97 +79,260 @@ def base(ticker, period):
     if df is None:
         return None 
 
-    return df.index, df['Close'].values, df['Open'].values
+    # Keep the index as plain datetime64 so it can be sliced and 
+    # compared against naive datetimes without converting again
+    idx = df.index
+    if idx.tz is not None:
+        idx = idx.tz_localize(None)
+
+    idx = np.asarray(idx.values, dtype='datetime64[ns]')
+    return idx, df['Close'].values, df['Open'].values
 
-def first(idx, close, open, smooth):
+def first(idx, close, open, smooth, per_week=5):
     if not type(close) is np.ndarray:
         close = np.array(close)
         open = np.array(open) 
         idx = np.array(idx, dtype='datetime64')
 
-    offset = max(1, int(smooth*5))
+    offset = max(1, int(smooth*per_week))
     deriv = (close[offset:] - open[:-offset]) / open[:-offset]
 
     return [idx[offset:], deriv]
 
-def second(idx, deriv, smooth):
+def second(idx, deriv, smooth, per_week=5):
     if not type(deriv) is np.ndarray:
         deriv = np.array(deriv)
 
-    offset = max(1, int(smooth*5))
+    offset = max(1, int(smooth*per_week))
 
     return [idx[offset:], (deriv[offset:] - deriv[:-offset]) ]
 
-def find_zeros(idx, series, time_cutoff=None, max_arrows=25):
-    # Dash likes to convert these to strings when going from 
-    # client to server... sigh
-    idx = pd.to_datetime(idx).array
-    
-    if not type(series) is np.ndarray:
-        series = np.array(series)
-
-    if time_cutoff:
-        print(type(time_cutoff))
-        print(idx)
-
-        idx = idx[idx >= time_cutoff]
-        series = series[-idx.shape[0]:]
-
-    gt = series>0
-    zero_days = np.logical_xor(gt[1:], gt[:-1])
-    idx = idx[1:][zero_days]
-
-    # Check any arrows need printing
-    if idx.shape[0] == 0:
-        return []
-
-    # Normalize between 0 and 1
-    magnitudes = series[1:][zero_days] - series[:-1][zero_days]
-    magnitudes = magnitudes - magnitudes.min() / (magnitudes.max() - magnitudes.min())
-    magnitudes -= 0.5
-    magnitudes *= 2
-
-    # Get indices of top 100 magnitudes
-    to_display = -min(max_arrows, magnitudes.shape[0])
-    max_mags = np.argpartition(
-        abs(magnitudes), to_display
-    )[to_display:]
-
-    annotations = []
-    for i in max_mags:
-        mag = magnitudes[i]
-        annotations.append(
-            dict(
-                arrowcolor='green' if mag > 0 else 'red',
-                x=idx[i],
-                y=mag,
-                xref="x", yref="y2",
-                text="",
-                showarrow=True,
-                axref = "x", ayref='y2',
-                ax=idx[i],
-                ay=0,
-                arrowhead = 3,
-                arrowwidth=1.5
-            )
-        )
+def differences(close, open, offset, order=MAX_ORDER):
+    '''
+    Derivatives 1..order at one offset as a single order x n array, row
+    k-1 being order k. Every row lines up with the full index and is
+    NaN until k*offset, so each order is just the row above minus
+    itself offset bars back. Works along the last axis, so close and
+    open can be tickers x bars too
+    '''
+    n = close.shape[-1]
+    rows = np.full((order,) + close.shape, np.nan)
+    if offset >= n or not order:
+        return rows
+
+    # The original get_all unpacked base() as idx, o, c and passed
+    # (c, o) to first, so the first derivative is the change from the
+    # close offset bars back to the open. This is the only place that
+    # knows, everything else passes the real close and open
+    rows[0, ..., offset:] = (open[..., offset:] - close[..., :-offset]) / close[..., :-offset]
+    for k in range(1, order):
+        rows[k, ..., offset:] = rows[k-1, ..., offset:] - rows[k-1, ..., :-offset]
+
+    return rows
+
+def derivatives(idx, close, open, smooth, per_week=5, order=MAX_ORDER):
+    '''
+    [idx, values] of every derivative up to order, the same as get_all
+    gets out of first and second for orders 1 and 2, see differences
+    '''
+    close, open = np.asarray(close, dtype=float), np.asarray(open, dtype=float)
+    idx = np.asarray(idx, dtype='datetime64[ns]')
+
+    offset = max(1, int(smooth*per_week))
+    rows = differences(close, open, offset, order)
+
+    return [[idx[k*offset:], rows[k-1, k*offset:]] for k in range(1, order+1)]
+
+class ZeroIndex:
+    '''
+    Every zero-crossing of a (second derivative) series, sorted by date.
+    The browser picks the biggest ones for whichever window is showing,
+    see arrows() in assets/clientside.js
+    '''
+    def __init__(self, idx, series):
+        gt = series>0
+        cross = np.flatnonzero(np.logical_xor(gt[1:], gt[:-1])) + 1
+
+        # A crossing is only inside a window if the day before it is
+        self.prev = idx[cross-1]
+        self.dates = idx[cross]
+        self.mags = series[cross] - series[cross-1]
+
+def zero_index(table, smooth, level='daily'):
+    '''
+    ZeroIndex of the second derivative for this smooth at one of LEVELS,
+    built the first time it's asked for and then kept with the table
+    '''
+    zeros = table.setdefault('zeros', dict())
+    if (smooth, level) not in zeros:
+        with metrics.timer(metrics.compute_seconds, what='zeros'):
+            zeros[(smooth, level)] = ZeroIndex(*lookup(table, smooth, level, 2)[2])
+
+    return zeros[(smooth, level)]
+
+def get_all(ticker, period='max', smooth=4, kernel='none'):
+    '''
+    Shared between workers, so popular tickers are usually
+    already computed by someone else
+    '''
+    key = results.key(ticker.upper(), period, smooth, kernel)
+    return flights.do(
+        ('all', key),
+        lambda: results.get_or_compute(key, lambda: compute_all(ticker, period, smooth, kernel))
+    )
+
+def get_all_many(tickers, period='max', smooth=4, kernel='none'):
+    '''
+    get_all for several tickers at once, as {ticker: get_all(ticker)}.
+    Uncached histories are downloaded in one batch, then the rest runs
+    concurrently, so this takes about as long as the slowest ticker
+    '''
+    return fetch_many(
+        lambda t: get_all(t, period=period, smooth=smooth, kernel=kernel), tickers
+    )
+
+def get_table_many(tickers, period='max', kernel='none'):
+    return fetch_many(lambda t: get_table(t, period=period, kernel=kernel), tickers)
+
+def fetch_many(fn, tickers):
+    tickers = [t.upper() for t in tickers]
+    provider = upstream()
 
-    return annotations
+    if USE_HISTORY_CACHE and not isinstance(provider, LocalProvider):
+        history_cache.prefetch(tickers, provider)
 
-def get_all(ticker, period='max', smooth=4):
+    return dict(zip(tickers, pool.map(fn, tickers)))
+
+def compute_all(ticker, period='max', smooth=4, kernel='none'):
+    table = get_table(ticker, period, kernel)
+    if table is None:
+        return None
+
+    return lookup(table, smooth)
+
+def get_table(ticker, period='max', kernel='none'):
+    '''
+    Base series plus first derivatives for every smooth up to
+    MAX_SMOOTH, see deriv_table, at every resolution in LEVELS. The
+    derivatives are of the prices smoothed with kernel (see
+    kernels.KERNELS). Everyone in the worker gets the same table object,
+    so treat it as read only
+    '''
+    key = table_key(ticker, period, kernel)
+    return flights.do(
+        ('table', key),
+        lambda: tables.get_or_compute(key, lambda: compute_table(ticker, period, kernel))
+    )
+
+def table_key(ticker, period='max', kernel='none'):
+    # Named after the layout so workers never read back entries
+    # pickled in an older one
+    return results.key(ticker.upper(), period, 'first', 'open', 'close', kernel)
+
+@metrics.timed(metrics.compute_seconds, what='table')
+def compute_table(ticker, period='max', kernel='none'):
     ret = base(ticker, period)
     if ret is None:
         return None
 
-    idx, o, c = ret 
-    d_idx, deriv = first(idx, c, o, smooth)
-    dd_idx, dderiv = second(d_idx, deriv, smooth)
+    idx, close, open = ret
+
+    # The daily table is the top level one, coarser ones hang off it
+    table = level_table(idx, close, open, LEVELS['daily'], kernel)
+    for level, per_week in LEVELS.items():
+        if level != 'daily':
+            table[level] = level_table(*resample(idx, close, open, level), per_week, kernel)
+
+    return table
+
+def level_table(idx, close, open, per_week, kernel='none'):
+    derivs = deriv_table(
+        kernels.apply(close, kernel), kernels.apply(open, kernel), per_week=per_week
+    )
+
+    # One contiguous buffer for the bars, every index used later on is
+    # a view into its date column
+    bars = np.empty((), dtype=bar_dtype(idx.shape[0]))
+    bars['date'], bars['open'], bars['close'] = idx, open, close
+
+    return {'bars': bars, 'derivs': derivs, 'per_week': per_week, 'kernel': kernel}
+
+def resample(idx, close, open, level):
+    '''
+    One bar per week (starting Monday) or month, dated by the last bar
+    in it. The close is the last bar's, the open the first's
+    '''
+    if level == 'weekly':
+        # 1970-01-01 was a Thursday
+        days = idx.astype('datetime64[D]').astype(np.int64)
+        key = (days + 3) // 7
+    else:
+        key = idx.astype('datetime64[M]').astype(np.int64)
+
+    ends = np.append(np.flatnonzero(key[1:] != key[:-1]), key.shape[0]-1)
+    starts = np.insert(ends[:-1]+1, 0, 0)
+
+    return idx[ends], close[ends], open[starts]
+
+def deriv_table(close, open, max_smooth=MAX_SMOOTH, per_week=5):
+    '''
+    The first derivative for every smooth in 0..max_smooth at once, as
+    one smooth x bars array. Row s is smooth=s, lined up with the bars
+    like differences. Stored as float32 to keep it small; higher orders
+    are a few subtractions away, see lookup
+    '''
+    n = close.shape[0]
+    table = np.full((max_smooth+1, n), np.nan, dtype=np.float32)
+
+    for s in range(max_smooth+1):
+        offset = max(1, int(s*per_week))
+        if offset >= n:
+            break
+
+        table[s] = differences(close, open, offset, 1)[0]
+
+    return table
+
+def bar_dtype(n):
+    '''
+    Layout of the bars kept for each ticker: a single record whose fields
+    are the n long columns, so each column is contiguous but they all live
+    in one buffer
+    '''
+    return np.dtype([('date', '<M8[ns]', (n,)), ('open', '<f8', (n,)), ('close', '<f8', (n,))])
+
+def lookup(table, smooth, level='daily', order=MAX_ORDER):
+    '''
+    Same as get_all, but starts from the precomputed first derivative in
+    table. Element k is order k up to order, the price being order 0 as
+    [idx, open, close], the order get_all has always returned them in
+    '''
+    if level != 'daily':
+        table = table[level]
+
+    bars = table['bars']
+    idx, open, close = bars['date'], bars['open'], bars['close']
+    per_week = table.get('per_week', 5)
+
+    derivs = table['derivs']
+
+    if smooth != int(smooth) or not 0 <= smooth < derivs.shape[0]:
+        kernel = table.get('kernel', 'none')
+        return [[idx, open, close]] + derivatives(
+            idx, kernels.apply(close, kernel), kernels.apply(open, kernel),
+            smooth, per_week, order
+        )
+
+    offset = max(1, int(smooth*per_week))
+    d = derivs[smooth, offset:]
+    ret = [[idx, open, close], [idx[offset:], d]]
+
+    # Each order is the one below minus itself offset bars back
+    for k in range(2, order+1):
+        d = d[offset:] - d[:-offset]
+        ret.append([idx[k*offset:], d])
 
-    return [
-        [idx, c, o],
-        [d_idx, deriv],
-        [dd_idx, dderiv]
-    ]
+    return ret
 
 def smoothing(x, N):
     if N == 0:
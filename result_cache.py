@@ -0,0 +1,239 @@
+import os
+import time
+import pickle
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from singleflight import file_lock
+
+# Shared by every gunicorn worker on the box, so a ticker computed by one
+# is a cache hit for all the others
+CACHE_PATH = os.environ.get(
+    'RESULT_CACHE_PATH',
+    os.path.join(tempfile.gettempdir(), 'stock_analyzer', 'results.sqlite')
+)
+TTL = int(os.environ.get('RESULT_CACHE_TTL', 15*60))
+MAX_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 256 * 2**20))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+'''
+
+class ResultCache:
+    '''
+    Pickled results in a local SQLite file. Entries expire ttl seconds
+    after they were stored, and the least recently read ones are dropped
+    once the total size goes over max_bytes
+    '''
+    def __init__(self, path=CACHE_PATH, ttl=TTL, max_bytes=MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        # sqlite connections can't be shared between threads, or
+        # across a fork, so each thread in each worker gets its own
+        if getattr(self.local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+
+            self.local.db = db
+            self.local.pid = os.getpid()
+
+        return self.local.db
+
+    @staticmethod
+    def key(*parts):
+        return '|'.join(str(p) for p in parts)
+
+    def get(self, key, count=True):
+        now = time.time()
+        row = self.db.execute(
+            'SELECT value FROM entries WHERE key=? AND created>?',
+            (key, now - self.ttl)
+        ).fetchone()
+
+        if row is None:
+            if count:
+                self.count('misses')
+            return None
+
+        self.db.execute('UPDATE entries SET accessed=? WHERE key=?', (now, key))
+        if count:
+            self.count('hits')
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+            (key, blob, len(blob), now, now)
+        )
+        self.evict(now)
+
+    def created(self, key):
+        '''
+        When the live entry for key was stored, None if there isn't one
+        '''
+        row = self.db.execute(
+            'SELECT created FROM entries WHERE key=? AND created>?',
+            (key, time.time() - self.ttl)
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def touch(self, key):
+        '''
+        Counts a read of key that didn't need the stored value
+        '''
+        self.db.execute('UPDATE entries SET accessed=? WHERE key=?', (time.time(), key))
+        self.count('hits')
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM entries WHERE key=?', (key,))
+
+    def get_or_compute(self, key, fn):
+        '''
+        Cached value for key, or fn() (stored, unless it's None). Only one
+        worker runs fn for a key at a time, the rest wait and read its result
+        '''
+        value = self.get(key)
+        if value is None:
+            with file_lock(('result', key)):
+                value = self.get(key, count=False)
+                if value is not None:
+                    self.count('hits')
+                else:
+                    value = fn()
+                    if value is not None:
+                        self.put(key, value)
+
+        return value
+
+    def evict(self, now=None):
+        now = time.time() if now is None else now
+        self.db.execute('DELETE FROM entries WHERE created<=?', (now - self.ttl,))
+
+        # Keep the most recently read entries that fit under the bound
+        self.db.execute('''
+            DELETE FROM entries WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS total
+                    FROM entries
+                ) WHERE total>?
+            )''', (self.max_bytes,)
+        )
+
+    def count(self, name):
+        self.db.execute('UPDATE counters SET value=value+1 WHERE name=?', (name,))
+
+    def stats(self):
+        counters = dict(self.db.execute('SELECT name, value FROM counters'))
+        entries, size = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+        ).fetchone()
+
+        counters.update(entries=entries, bytes=size)
+        return counters
+
+    def clear(self):
+        self.db.execute('DELETE FROM entries')
+        self.db.execute('UPDATE counters SET value=0')
+
+
+class LocalCache:
+    '''
+    The last max_entries values read through a ResultCache, kept as
+    objects in this process so everyone reading a key shares one copy
+    instead of unpickling their own. A copy is only handed out while
+    it's still the one stored in the ResultCache, checked at most every
+    recheck seconds, so whatever another worker stores (or expires, or
+    deletes) is picked up soon after
+    '''
+    def __init__(self, cache, max_entries, recheck=5):
+        self.cache = cache
+        self.max_entries = max_entries
+        self.recheck = recheck
+
+        # key -> [created, value, checked, touched]. Reading created or
+        # touching a big entry walks its whole blob, so neither happens
+        # on every read
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+
+        if now - entry[2] > self.recheck:
+            if self.cache.created(key) != entry[0]:
+                with self.lock:
+                    self.entries.pop(key, None)
+                return None
+            entry[2] = now
+
+        # Keeps the ResultCache from evicting it for being unread
+        if now - entry[3] > self.cache.ttl / 4:
+            self.cache.touch(key)
+            entry[3] = now
+
+        return entry[1]
+
+    def get_or_compute(self, key, fn):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        value = self.cache.get_or_compute(key, fn)
+        if value is not None:
+            self.keep(key, value)
+
+        return value
+
+    def put(self, key, value):
+        self.cache.put(key, value)
+        self.keep(key, value)
+
+    def keep(self, key, value):
+        created = self.cache.created(key)
+        if created is None:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.entries[key] = [created, value, now, now]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+results = ResultCache()
@@ -0,0 +1,148 @@
+'''
+Screens a whole universe of tickers for recent zero-crossings of the
+second derivative, the same ones the forecast arrows mark.
+
+    python screener.py SPY QQQ AAPL          # these tickers
+    python screener.py --universe sp500.txt  # one ticker per line
+    python screener.py                       # everything in MARKET_DATA_DIR
+
+Every ticker's last bars go into one tickers x bars array (left padded
+with NaN for short histories) so the derivatives and crossings for all
+of them are a handful of numpy operations.
+'''
+import os
+import sys
+import argparse
+import numpy as np
+
+import queries as q
+from providers import get_provider, LocalProvider
+
+# Bars kept per ticker on top of the 2*offset the derivatives eat up.
+# Crossing strength is measured against the second derivative over these
+LOOKBACK = int(os.environ.get('SCREENER_LOOKBACK', 260))
+
+# Newline separated tickers screened when none are given
+UNIVERSE = os.environ.get('SCREENER_UNIVERSE')
+
+def universe():
+    '''
+    Tickers in SCREENER_UNIVERSE, or everything in the local dataset
+    '''
+    if UNIVERSE:
+        with open(UNIVERSE) as f:
+            return [l.strip().upper() for l in f if l.strip()]
+
+    provider = get_provider()
+    if isinstance(provider, LocalProvider):
+        return provider.tickers()
+
+    return []
+
+def load(tickers, bars=None, period='2y'):
+    '''
+    The last bars bars of every ticker (all of them if None) as
+    (tickers, dates, close, open), each tickers x bars. Short histories
+    are left padded with NaT/NaN and tickers without data are dropped
+    '''
+    provider = get_provider()
+    if isinstance(provider, LocalProvider) and bars is not None:
+        # Straight off the memory mapped files
+        loaded = {t: provider.tail(t, bars) for t in tickers}
+        loaded = {
+            t: (r['date'], r['close'], r['open'])
+            for t, r in loaded.items() if r is not None
+        }
+    else:
+        loaded = q.fetch_many(lambda t: q.base(t, period), tickers)
+
+    loaded = [(t, ret) for t, ret in loaded.items() if ret is not None]
+    if bars is None:
+        bars = max([ret[0].shape[0] for _, ret in loaded], default=0)
+
+    dates = np.full((len(loaded), bars), np.datetime64('NaT'), dtype='datetime64[ns]')
+    closes = np.full((len(loaded), bars), np.nan)
+    opens = np.full((len(loaded), bars), np.nan)
+
+    for row, (_, (idx, close, open)) in enumerate(loaded):
+        n = min(bars, idx.shape[0])
+        dates[row, bars-n:] = idx[-n:]
+        closes[row, bars-n:] = close[-n:]
+        opens[row, bars-n:] = open[-n:]
+
+    return [t for t, _ in loaded], dates, closes, opens
+
+def screen(tickers=None, smooth=4, within=5, top=50, period='2y'):
+    '''
+    Tickers whose second derivative crossed zero in the last within
+    bars, strongest first. Strength is the jump across zero in standard
+    deviations of that ticker's second derivative
+    '''
+    tickers = universe() if tickers is None else [t.upper() for t in tickers]
+    offset = max(1, int(smooth*5))
+
+    tickers, dates, close, open = load(tickers, LOOKBACK + 2*offset, period)
+    if not tickers:
+        return []
+
+    # First and second derivatives for every row at once
+    d, dd = q.differences(close, open, offset, 2)
+    d, dd = d[:, offset:], dd[:, 2*offset:]
+    dates = dates[:, 2*offset:]
+
+    # Sign changes, same as ZeroIndex but NaN padding never counts
+    valid = np.isfinite(dd)
+    gt = dd > 0
+    cross = (gt[:, 1:] != gt[:, :-1]) & valid[:, 1:] & valid[:, :-1]
+
+    # Latest crossing in each row
+    has = cross.any(axis=1)
+    last = cross.shape[1] - 1 - np.argmax(cross[:, ::-1], axis=1)
+    ago = cross.shape[1] - 1 - last
+
+    rows = np.arange(len(tickers))
+    mags = dd[rows, last+1] - dd[rows, last]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        strength = np.abs(mags) / np.nanstd(dd, axis=1)
+
+    hits = np.flatnonzero(has & (ago < within) & np.isfinite(strength))
+    hits = hits[np.argsort(-strength[hits], kind='stable')][:top]
+
+    return [
+        {
+            'ticker': tickers[i],
+            'date': str(dates[i, last[i]+1].astype('datetime64[D]')),
+            'bars_ago': int(ago[i]),
+            'signal': 'buy' if mags[i] > 0 else 'sell',
+            'strength': float(strength[i]),
+            'first': float(d[i, -1]),
+            'second': float(dd[i, -1])
+        }
+        for i in hits
+    ]
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('tickers', nargs='*')
+    ap.add_argument('--universe', help='file with one ticker per line')
+    ap.add_argument('--smooth', type=float, default=4)
+    ap.add_argument('--within', type=int, default=5, help='only crossings in the last this many bars')
+    ap.add_argument('--top', type=int, default=50)
+    args = ap.parse_args()
+
+    tickers = args.tickers or None
+    if args.universe:
+        with open(args.universe) as f:
+            tickers = [l.strip() for l in f if l.strip()]
+
+    hits = screen(tickers, smooth=args.smooth, within=args.within, top=args.top)
+    if not hits:
+        print('Nothing crossed zero in the last', args.within, 'bars')
+        sys.exit(0)
+
+    print('%-8s %-10s %4s %-4s %8s' % ('ticker', 'date', 'ago', '', 'strength'))
+    for h in hits:
+        print('%-8s %-10s %4d %-4s %8.2f' % (h['ticker'], h['date'], h['bars_ago'], h['signal'], h['strength']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import queries as q
+
+# How many browser sessions each worker keeps series for, and how long
+# an idle session survives before it's thrown out
+MAX_SESSIONS = int(os.environ.get('SERIES_STORE_SESSIONS', 256))
+SESSION_TTL = int(os.environ.get('SERIES_STORE_TTL', 60*60))
+
+class Series:
+    '''
+    One ticker in a session. The table is the one queries.get_table
+    hands every session in the worker (see queries.tables). Prices and
+    first derivatives are views into it and higher orders are worked out
+    from those when they're drawn, so nothing is kept per session.
+    Tickers that failed to load are Series.missing(ticker), which have
+    no table and never draw anything
+    '''
+    __slots__ = ('ticker', 'table', 'smooth', 'kernel', 'shown')
+    levels = list(q.LEVELS)
+
+    def __init__(self, ticker, table, smooth, kernel='none'):
+        self.ticker = ticker
+        self.table = table
+        self.smooth = smooth
+        self.kernel = kernel
+        self.shown = []
+
+    @classmethod
+    def missing(cls, ticker, kernel='none'):
+        return cls(ticker, None, None, kernel)
+
+    @property
+    def found(self):
+        return self.table is not None
+
+    def trace(self, deriv, level='daily'):
+        '''
+        (idx, values) of the price (0) or a derivative (1..MAX_ORDER) at
+        the current smoothing, from one of q.LEVELS
+        '''
+        return q.lookup(self.table, self.smooth, level, deriv)[deriv]
+
+    def zeros(self, level='daily'):
+        return q.zero_index(self.table, self.smooth, level)
+
+    def version(self, deriv):
+        '''
+        Changes when new bars come in, or the smoothing or kernel do
+        '''
+        idx = self.trace(deriv)[0]
+        last = str(idx[-1]) if len(idx) else ''
+        return last if deriv == 0 else '%s:%d:%s' % (last, self.smooth, self.kernel)
+
+
+class SeriesStore:
+    '''
+    Server-side replacement for shipping the graph cache through dcc.Store.
+    The browser only holds the session id; the numpy arrays live here.
+    Sessions are evicted least-recently-used first, or when they've been
+    idle for longer than ttl seconds.
+    '''
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        sid = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[sid] = (time.time(), dict())
+            self._evict()
+
+        return sid
+
+    def get(self, sid):
+        '''
+        Returns the ticker -> series dict for this session. If the session
+        was evicted (or lives on another worker) an empty one is created
+        under the same id, and callers refill it on demand
+        '''
+        with self.lock:
+            if sid in self.sessions:
+                _, cached = self.sessions.pop(sid)
+            else:
+                cached = dict()
+
+            self.sessions[sid] = (time.time(), cached)
+            self._evict()
+
+        return cached
+
+    def clear(self, sid):
+        with self.lock:
+            self.sessions[sid] = (time.time(), dict())
+
+    def drop(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def _evict(self):
+        oldest = time.time() - self.ttl
+        while self.sessions:
+            sid, (last_used, _) = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and last_used >= oldest:
+                break
+
+            del self.sessions[sid]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+store = SeriesStore()
@@ -0,0 +1,83 @@
+import os
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_DIR = os.environ.get(
+    'SINGLEFLIGHT_LOCK_DIR',
+    os.path.join(tempfile.gettempdir(), 'stock_analyzer', 'locks')
+)
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    '''
+    Coalesces concurrent calls within a process: while fn is running for
+    a key, anyone else asking for the same key waits and gets the same
+    result (or exception) instead of running it again
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+
+@contextmanager
+def file_lock(key):
+    '''
+    Same idea across worker processes: only one holder per key at a time.
+    Whoever gets it second should re-check whatever cache the first one
+    filled before doing the work again
+    '''
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    name = hashlib.md5(str(key).encode()).hexdigest() + '.lock'
+
+    with open(os.path.join(LOCK_DIR, name), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+flights = Group()
@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import pandas as pd
 from datetime import datetime as dt, timedelta as td, MINYEAR
 
@@ -9,6 +11,10 @@ THREE_M = 70
 ONE_M = 80
 ONE_W = 90
 
+# A window is drawn from the coarsest price level that still has at
+# least this many bars in it
+MIN_POINTS = int(os.environ.get('MIN_POINTS', 200))
+
 # Maps var names to num of days 
 time_map = {
     FIVE_Y: 365*5,
@@ -29,4 +35,29 @@ def get_delta(dif):
     days = time_map[dif]
     delta = td(days=days)
 
-    return now-delta
\ No newline at end of file
+    return now-delta
+
+def since(idx, start):
+    '''
+    Position of the first date >= start in the sorted datetime64 
+    array idx, so idx[since(idx, start):] is a view, not a copy
+    '''
+    if start is None:
+        return 0
+
+    return np.searchsorted(idx, np.datetime64(start, 'ns'))
+
+def get_level(dif, indexes):
+    '''
+    Picks what to draw the window dif from. indexes is a list of
+    (level, sorted datetime64 index) from coarsest to finest; returns
+    the first level that fills the chart (the finest if none does) and
+    where the window starts in it
+    '''
+    start = get_delta(dif)
+    for level, idx in indexes:
+        i = since(idx, start)
+        if idx.shape[0] - i >= MIN_POINTS:
+            break
+
+    return level, i